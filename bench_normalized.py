@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import tempfile
+import time
+import sqlite3 as sqlite
+import numpy as np
+
+# local
+from classes import Index
+
+
+def make_indent_index(path, rows, depth=5, width=8, seed=0):
+    """This function writes a random tab indented index with the given number of rows, in which every heading has
+    width sub-headings down to depth levels and the deepest entries have pages. The words of the headings are picked
+    at random, so that indices made with different seeds have different headings."""
+    rng = np.random.default_rng(seed)
+    words = ['Combat', 'Actions', 'Equipment', 'Spellcasting', 'Movement', 'Conditions', 'Adventuring', 'Monsters']
+    with open(path, 'w') as f:
+        count = 0
+        stack = [0]
+        while count < rows:
+            level = len(stack) - 1
+            label = ' '.join((rng.choice(words), 'and', rng.choice(words), str(stack[-1])))
+            if level == depth - 1:
+                f.write('\t' * level + '{!s}, {!s}\n'.format(label, rng.integers(1, 400)))
+            else:
+                f.write('\t' * level + label + '\n')
+            count += 1
+            if level < depth - 1:
+                stack.append(0)
+            else:
+                stack[-1] += 1
+                while len(stack) > 1 and stack[-1] >= width:
+                    stack.pop()
+                    stack[-1] += 1
+
+
+def db_size(dbpath):
+    con = sqlite.connect(dbpath)
+    con.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    con.execute("VACUUM;")
+    con.close()
+    return os.path.getsize(dbpath)
+
+
+def best_time(func, repeat=5):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        n = len(func())
+        times.append(time.perf_counter() - start)
+    return n, min(times)
+
+
+def time_queries(dbpath, normalized, selected=20, repeat=5):
+    """This function times the heading list query run by ExportForm when the publications are selected, and the entry
+    list query run when selected headings are then selected."""
+    con = sqlite.connect(dbpath)
+    labels = [row[0] for row in con.execute("SELECT label FROM pub_summary;")]
+    marks = ','.join('?' * len(labels))
+    if normalized:
+        # as in ExportForm, the listed headings and their parents are read and their paths built from them
+        ids = '\n'.join((
+            "SELECT DISTINCT n.heading_id ",
+            "  FROM pub_summary AS s ",
+            " INNER JOIN node AS n ON n.pubkey = s.pubkey AND n.version = s.version ",
+            " WHERE s.label IN ({!s}) ",
+            "   AND n.page IS NOT NULL")).format(marks)
+        sql = Index.heading_tree_sql.format(ids=ids)
+
+        def list_headings():
+            paths = Index.heading_paths(con.execute(sql, labels * 2))
+            return sorted(((v[0], k) for k, v in paths.items()), key=lambda x: x[0].lower())
+    else:
+        sql = '\n'.join((
+            "SELECT idx_text FROM indices AS a ",
+            " INNER JOIN pub AS b ON a.pubkey = b.pubkey ",
+            " WHERE b.title || ' (' || a.version || ')' IN ({!s}) ",
+            "   AND a.page IS NOT NULL ",
+            " GROUP BY a.idx_text ",
+            " ORDER BY lower(a.idx_text);")).format(marks)
+
+        def list_headings():
+            return con.execute(sql, labels).fetchall()
+    headings = list_headings()
+    n, heading_time = best_time(list_headings, repeat)
+    headings = headings[::max(1, len(headings) // selected)][:selected]
+    paths = [row[0] for row in headings]
+    if normalized:
+        # as in ExportForm, node rows are matched by the ids read with the heading list
+        ids = [row[1] for row in headings]
+        sql = '\n'.join((
+            "SELECT l.text, n.notes ",
+            "  FROM pub_summary AS s ",
+            " INNER JOIN node AS n ON n.pubkey = s.pubkey AND n.version = s.version ",
+            " INNER JOIN heading AS h ON h.id = n.heading_id ",
+            " INNER JOIN label AS l ON l.id = h.label_id ",
+            " WHERE n.heading_id IN ({!s}) ",
+            "   AND s.label IN ({!s}) ",
+            "   AND n.page IS NOT NULL ",
+            " GROUP BY l.text ORDER BY n.idx;")).format(','.join('?' * len(ids)), marks)
+        params = ids + labels
+    else:
+        sql = '\n'.join((
+            "SELECT a.entry, a.notes ",
+            "  FROM indices AS a ",
+            " INNER JOIN pub AS b ON a.pubkey = b.pubkey ",
+            " WHERE a.idx_text IN ({!s}) ",
+            "   AND b.title || ' (' || a.version || ')' IN ({!s}) ",
+            "   AND a.page IS NOT NULL ",
+            " GROUP BY a.entry ORDER BY a.idx;")).format(','.join('?' * len(paths)), marks)
+        params = paths + labels
+    m, entry_time = best_time(lambda: con.execute(sql, params).fetchall(), repeat)
+    con.close()
+    return n, heading_time, m, entry_time
+
+
+if __name__ == "__main__":
+    # parses script arguments
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Compares the size and the heading and entry list query times of a '
+                                                 'flat and a normalized database built from the same random deep '
+                                                 'indices.')
+    parser.add_argument('-r', '--rows', type=int, default=200000, help='The number of rows per index.')
+    parser.add_argument('-d', '--depth', type=int, default=5, help='The number of heading levels.')
+    parser.add_argument('-n', '--indices', type=int, default=4,
+                        help='The number of different indices to import, all listed together.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i in range(args.indices):
+            paths.append(os.path.join(tmp, 'index{!s}.txt'.format(i)))
+            make_indent_index(paths[-1], rows=args.rows, depth=args.depth, seed=i)
+        for normalized in [False, True]:
+            dbpath = os.path.join(tmp, 'normalized.db' if normalized else 'flat.db')
+            load_time = 0
+            for i, path in enumerate(paths):
+                start = time.perf_counter()
+                Index(path=path, dbpath=dbpath, pubkey='bench{!s}'.format(i), version='1',
+                      bib={'title': 'Bench {!s}'.format(i)}, normalized=normalized).dict_to_db()
+                load_time += time.perf_counter() - start
+                if i == 0:
+                    single_size = db_size(dbpath)
+            n, heading_time, m, entry_time = time_queries(dbpath, normalized)
+            print('{:<10} size {:>6.1f} MB ({:.1f} MB for one index), import {:.1f}s, {:,} headings listed in {:.3f}s, '
+                  '{:,} entries of 20 headings in {:.4f}s'
+                  .format('normalized' if normalized else 'flat', db_size(dbpath) / 2 ** 20, single_size / 2 ** 20,
+                          load_time, n, heading_time, m, entry_time))
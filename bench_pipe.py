@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+import argparse
+import time
+import numpy as np
+import pandas as pd
+
+# local
+from misc import create_pipe_idx, create_pipe_idx_loop
+
+
+def make_pipe_df(rows, depth=4, width=20, seed=0):
+    """This function creates a random 'pipe' format index with the given number of rows, where each path has between 1
+    and depth categories, each chosen from width names."""
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, depth + 1, size=rows)
+    parts = pd.DataFrame(rng.integers(0, width, size=(rows, depth))).astype(str).radd('c')
+    paths = parts[0]
+    for i in range(1, depth):
+        paths = paths.where(lengths <= i, paths + '|' + parts[i])
+    return pd.DataFrame({'idx_text': paths, 'page': rng.integers(1, 500, size=rows)})
+
+
+if __name__ == "__main__":
+    # parses script arguments
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Times create_pipe_idx() on a random pipe format index and checks it '
+                                                 'against the original looping version on a smaller sample.')
+    parser.add_argument('-r', '--rows', type=int, default=1000000, help='The number of rows to time.')
+    parser.add_argument('-c', '--check_rows', type=int, default=20000,
+                        help='The number of rows on which to compare against (and time) create_pipe_idx_loop().')
+    parser.add_argument('-d', '--depth', type=int, default=4, help='The maximum number of categories in a path.')
+    args = parser.parse_args()
+
+    df = make_pipe_df(rows=args.check_rows, depth=args.depth)
+    start = time.perf_counter()
+    old = create_pipe_idx_loop(df)
+    old_time = time.perf_counter() - start
+    start = time.perf_counter()
+    new = create_pipe_idx(df)
+    new_time = time.perf_counter() - start
+    pd.testing.assert_frame_equal(new, old, check_dtype=False)
+    print('{:,} rows: create_pipe_idx_loop {:.2f}s, create_pipe_idx {:.2f}s, outputs match'
+          .format(args.check_rows, old_time, new_time))
+
+    df = make_pipe_df(rows=args.rows, depth=args.depth)
+    start = time.perf_counter()
+    create_pipe_idx(df)
+    print('{:,} rows: create_pipe_idx {:.2f}s'.format(args.rows, time.perf_counter() - start))
@@ -3,6 +3,13 @@ import pandas as pd
 import sqlite3 as sqlite
 import re
 import os
+import time
+import threading
+import queue
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where writers rely on the sqlite busy timeout alone
+    fcntl = None
 
 # ExportForm
 import tkinter as tk
@@ -11,6 +18,44 @@ from tkinter.ttk import *
 import subprocess
 import json
 import shlex
+from bisect import bisect_left
+from array import array
+
+# Bibliography
+import bibtexparser
+from bibtexparser.bwriter import BibTexWriter
+from bibtexparser.bibdatabase import BibDatabase
+
+# local
+from misc import get_pipe, create_pipe_idx
+from export_index import idx_key
+
+
+class WriteLock:
+    """
+    This class is a context manager around an exclusive lock on a '.lock' file next to a sqlite database, so that
+    separate processes importing into the same database take turns rather than failing with 'database is locked'.
+    The time spent waiting for the lock is kept in wait.
+    """
+
+    def __init__(self, dbpath):
+        self.path = dbpath + '.lock'  # the path to the lock file
+        self.file = None
+        self.wait = 0.0  # seconds spent waiting for the lock
+
+    def __enter__(self):
+        start = time.perf_counter()
+        if fcntl is not None:
+            self.file = open(self.path, 'a')
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        self.wait = time.perf_counter() - start
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
 
 
 class Index:
@@ -22,12 +67,18 @@ class Index:
             Level 1.1.1 ##, See note
         Level 1.2
             See also note
+    or, with fmt='pipe', a delimited file of category paths and pages in the form of:
+    Level 1|Level 1.1<tab>##, ##-##
     """
 
     def __init__(self, path, dbpath=None, delimiter='|', pubkey=None, abbr=None, link=None, adjust=0, conflict='fail',
-                 version=None, bib=None):
+                 version=None, bib=None, fmt='indent', sep='\t', pipe_delim='|', timeout=60, normalized=False,
+                 wal=False):
         # index specific attributes
         self.path = path  # the file path to the index text
+        self.fmt = fmt  # ['indent', 'pipe'] the format of the index text
+        self.sep = sep  # the field delimiter between the category path and pages of a 'pipe' format index
+        self.pipe_delim = pipe_delim  # the delimiter between categories of a 'pipe' format index
         self.dbpath = dbpath  # the path to the sqlite database
         self.version = version  # the index version (e.g. 'original', 'improved', etc.)
         self.delimiter = delimiter  # the delimiter to use to separate index text (e.g. level|sublevel|item)
@@ -36,6 +87,9 @@ class Index:
         self.link = link  # the path to the pdf of the document
         self.adjust = adjust  # the number of pages to adjust the pdf such that it opens to the proper index page
         self.conflict = conflict  # ['fail', 'ignore', 'replace'] for db insert
+        self.timeout = timeout  # seconds to wait for another connection's write lock before failing
+        self.normalized = normalized  # create a new database with the heading/node schema instead of a flat table
+        self.wal = wal  # switch the database to write-ahead logging (not for databases on network filesystems)
 
         # BibTex attributes
         self.bib = bib  # the BibTeX style entries ion dictionary form
@@ -58,6 +112,7 @@ class Index:
 
     def dict_to_df(self):
         """This function converts the output of get_indent() to a data frame."""
+        rows = []
         for d in self.dict_index:
             new_d = dict()
             new_d['entry'] = d['text']
@@ -65,7 +120,8 @@ class Index:
             new_d['idx_text'] = self.idx_dict_to_text(idx=d['idx_text'], delim=self.delimiter)
             new_d['page'] = d['p']
             new_d['notes'] = d['note']
-            self.df_index = self.df_index.append(new_d, ignore_index=True)
+            rows.append(new_d)
+        self.df_index = pd.DataFrame(rows, columns=['entry', 'idx', 'idx_text', 'page', 'notes'])
         if self.version:
             self.df_index.insert(0, 'version', self.version)
         if self.pubkey:
@@ -141,6 +197,33 @@ class Index:
                 break
         self.dict_index = outlist
 
+    def pipe_to_dict(self):
+        """This function takes an input index of delimited category paths (e.g. category|sub|entry) and pages and
+        converts it to the same dictionary form as text_to_dict(), adding rows for any categories that only appear as
+        part of a longer path."""
+        df = create_pipe_idx(get_pipe(self.path, delim=self.sep), delim=self.pipe_delim)
+        nodes = dict()
+        for row in df.itertuples(index=False):
+            idx_list = row.idx.split('.')
+            text_list = row.idx_text.split(self.pipe_delim)
+            for level in range(len(idx_list)):
+                key = tuple(int(x) for x in idx_list[:level + 1])
+                if key not in nodes:
+                    nodes[key] = {'tab_no': level, 'text': text_list[level], 'note': None, 'p': None,
+                                  'idx': dict(enumerate(key)), 'idx_text': dict(enumerate(text_list[:level + 1]))}
+            if pd.notna(row.page):
+                # a repeated path has its pages combined into a single entry
+                p_list = [x for x in [nodes[key]['p'], str(row.page)] if x]
+                nodes[key]['p'] = ', '.join(p_list)
+        self.dict_index = [nodes[key] for key in sorted(nodes)]
+
+    def read_index(self):
+        """This function converts the input index to a dictionary using the parser for its format."""
+        if self.fmt == 'pipe':
+            self.pipe_to_dict()
+        else:
+            self.text_to_dict()
+
     def construct_tree(self, current_list, level=0):
         sub_list = []
         for i, item in enumerate(current_list):
@@ -184,14 +267,29 @@ class Index:
         self.tree_index['entries'] = self.construct_tree(current_list=self.dict_index, level=0)
 
     def create_db(self):
-        con = sqlite.connect(self.dbpath)
+        con = sqlite.connect(self.dbpath, timeout=self.timeout)
         c = con.cursor()
-        sql_list = [
-            "CREATE TABLE IF NOT EXISTS indices (pubkey TEXT, version TEXT, entry TEXT, idx TEXT, idx_text TEXT, "
-            "page TEXT, notes TEXT, PRIMARY KEY (pubkey, version, idx));",
+        if self.wal:
+            # write-ahead logging lets readers (e.g. ExportForm) carry on while an import is being written. It is a
+            # persistent setting of the database file and is not supported on network filesystems, so it is opt-in.
+            c.execute("PRAGMA journal_mode=WAL;")
+        if self.normalized and not c.execute("SELECT 1 FROM sqlite_master WHERE name = 'indices';").fetchone():
+            sql_list = self.normalized_sql + [sql.format(delim=self.sql_text(self.delimiter))
+                                              for sql in self.normalized_view_sql]
+        elif self.is_normalized(con):
+            sql_list = []
+        else:
+            sql_list = [
+                "CREATE TABLE IF NOT EXISTS indices (pubkey TEXT, version TEXT, entry TEXT, idx TEXT, idx_text TEXT, "
+                "page TEXT, notes TEXT, PRIMARY KEY (pubkey, version, idx));"
+            ]
+        sql_list += [
             "CREATE TABLE IF NOT EXISTS pub (pubkey TEXT PRIMARY KEY, author TEXT, title TEXT, abbr TEXT, edition TEXT,"
             " publisher TEXT, month TEXT, year INTEGER, volume TEXT, series TEXT, address TEXT, note TEXT, isbn TEXT,"
-            " link TEXT, adjust INTEGER DEFAULT (0));"
+            " link TEXT, adjust INTEGER DEFAULT (0));",
+            self.summary_sql,
+            self.xref_sql,
+            self.xref_target_sql
         ]
         for sql in sql_list:
             # print(sql)
@@ -199,52 +297,684 @@ class Index:
         con.commit()
         con.close()
 
+    # the normalized schema: each distinct label is stored once, each distinct heading once (as a label under a
+    # parent heading, shared by all publications), and each index row refers to its heading by id. The path of a
+    # heading is not stored but built from its parents when it is read.
+    normalized_sql = [
+        "CREATE TABLE IF NOT EXISTS label (id INTEGER PRIMARY KEY, text TEXT UNIQUE);",
+        "CREATE TABLE IF NOT EXISTS heading (id INTEGER PRIMARY KEY, parent_id INTEGER, label_id INTEGER, "
+        "depth INTEGER, UNIQUE (parent_id, label_id));",
+        "CREATE TABLE IF NOT EXISTS node (pubkey TEXT, version TEXT, idx TEXT, heading_id INTEGER, page TEXT, "
+        "notes TEXT, PRIMARY KEY (pubkey, version, idx));",
+        # lets the heading list read distinct heading ids of the selected publications from the index alone
+        "CREATE INDEX IF NOT EXISTS node_heading ON node (pubkey, version, heading_id) WHERE page IS NOT NULL;"
+    ]
+
+    # heading_path presents each heading with its label and path, built down from the top level headings, and indices
+    # presents the normalized tables with the same columns as the flat indices table. {delim} is the quoted delimiter
+    # the paths are joined with.
+    normalized_view_sql = [
+        "DROP VIEW IF EXISTS indices;",
+        "DROP VIEW IF EXISTS heading_path;",
+        '\n'.join(("CREATE VIEW heading_path AS ",
+                   "WITH RECURSIVE p (id, parent_id, depth, label, path) AS (",
+                   "SELECT h.id, h.parent_id, h.depth, l.text, l.text ",
+                   "  FROM heading AS h ",
+                   "  JOIN label AS l ON l.id = h.label_id ",
+                   " WHERE h.parent_id = 0 ",
+                   " UNION ALL ",
+                   "SELECT h.id, h.parent_id, h.depth, l.text, p.path || {delim} || l.text ",
+                   "  FROM p ",
+                   "  JOIN heading AS h ON h.parent_id = p.id ",
+                   "  JOIN label AS l ON l.id = h.label_id) ",
+                   "SELECT id, parent_id, depth, label, path FROM p;")),
+        '\n'.join(("CREATE VIEW indices AS ",
+                   "SELECT n.pubkey, n.version, p.label AS entry, n.idx, p.path AS idx_text, n.page, n.notes ",
+                   "  FROM node AS n ",
+                   "  JOIN heading_path AS p ON p.id = n.heading_id;"))
+    ]
+
+    # the headings with an id in {ids} and all of their parents, each read once however many headings share it, with
+    # whether it is one of the headings asked for. heading_paths() builds the paths from these rows.
+    heading_tree_sql = '\n'.join((
+        "WITH RECURSIVE a (id) AS (",
+        "SELECT * FROM ({ids}) ",
+        " UNION ",
+        "SELECT h.parent_id ",
+        "  FROM a ",
+        " INNER JOIN heading AS h ON h.id = a.id ",
+        " WHERE h.parent_id != 0) ",
+        "SELECT h.id, h.parent_id, l.text, h.id IN ({ids}) ",
+        "  FROM a ",
+        " INNER JOIN heading AS h ON h.id = a.id ",
+        " INNER JOIN label AS l ON l.id = h.label_id;"))
+
+    @staticmethod
+    def heading_paths(rows, delimiter='|'):
+        """This function takes the (id, parent_id, label, listed) rows of heading_tree_sql and returns the path and
+        label of each listed heading by id."""
+        tree = {row[0]: row[1:] for row in rows}
+        paths = dict()
+        for heading_id in tree:
+            # walks up to the nearest heading with a known path, then builds the paths back down
+            stack = []
+            while heading_id and heading_id not in paths:
+                stack.append(heading_id)
+                heading_id = tree[heading_id][0]
+            for x in reversed(stack):
+                parent_id, label = tree[x][:2]
+                paths[x] = delimiter.join((paths[parent_id], label)) if parent_id else label
+        return {k: (v, tree[k][1]) for k, v in paths.items() if tree[k][2]}
+
+    @staticmethod
+    def sql_text(text):
+        """This function quotes text as an sql string literal."""
+        return "'" + text.replace("'", "''") + "'"
+
+    @staticmethod
+    def is_normalized(con):
+        """This function tests whether a database uses the normalized schema, in which indices is a view."""
+        return con.execute("SELECT type FROM sqlite_master WHERE name = 'indices';").fetchone() == ('view',)
+
+    def intern_rows(self, con, rows):
+        """This function adds the labels and headings of rows to the label and heading tables where they are not
+        already present, and returns the rows in the form of the node table."""
+        labels = dict()
+        headings = dict()
+
+        def get_id(cache, key, select_sql, insert_sql):
+            if key not in cache:
+                rec = con.execute(select_sql, key).fetchone()
+                cache[key] = rec[0] if rec else con.execute(insert_sql, key).lastrowid
+            return cache[key]
+
+        node_rows = []
+        heading_ids = dict()  # (pubkey, version, idx): heading id of the rows interned so far
+        # parents first, so that the heading of a row's parent is known by the time the row is reached. The entry is
+        # the label of the row's heading, so that an entry containing the delimiter is kept whole.
+        for row in sorted(rows, key=lambda x: x['idx'].count('.')):
+            depth = row['idx'].count('.')
+            parent_id = 0
+            if depth:
+                parent = (row['pubkey'], row['version'], row['idx'].rsplit('.', 1)[0])
+                if parent not in heading_ids:
+                    # the parent row is already stored (e.g. when only changed rows are synced)
+                    rec = con.execute("SELECT heading_id FROM node WHERE pubkey = ? AND version = ? AND idx = ?;",
+                                      parent).fetchone()
+                    if rec is None:
+                        raise ValueError('row {!s} has no parent row {!s}'.format(row['idx'], parent[2]))
+                    heading_ids[parent] = rec[0]
+                parent_id = heading_ids[parent]
+            label_id = get_id(labels, (row['entry'],), "SELECT id FROM label WHERE text = ?;",
+                              "INSERT INTO label (text) VALUES (?);")
+            heading_id = get_id(headings, (parent_id, label_id, depth),
+                                "SELECT id FROM heading WHERE parent_id = ? AND label_id = ? AND depth = ?;",
+                                "INSERT INTO heading (parent_id, label_id, depth) VALUES (?, ?, ?);")
+            heading_ids[(row['pubkey'], row['version'], row['idx'])] = heading_id
+            node_rows.append({'pubkey': row['pubkey'], 'version': row['version'], 'idx': row['idx'],
+                              'heading_id': heading_id, 'page': row['page'], 'notes': row['notes']})
+        return node_rows
+
+    # one row per pubkey/version so that the list of publications never has to scan the indices table
+    summary_sql = "CREATE TABLE IF NOT EXISTS pub_summary (pubkey TEXT, version TEXT, title TEXT, label TEXT, " \
+                  "entry_count INTEGER, heading_count INTEGER, page_min INTEGER, page_max INTEGER, " \
+                  "PRIMARY KEY (pubkey, version));"
+
+    # 'See' and 'See also' notes resolved to the idx they point to (NULL if no match was found)
+    xref_sql = "CREATE TABLE IF NOT EXISTS xref (pubkey TEXT, version TEXT, idx TEXT, target TEXT, kind TEXT, " \
+               "target_idx TEXT, PRIMARY KEY (pubkey, version, idx, target));"
+    xref_target_sql = "CREATE INDEX IF NOT EXISTS xref_target ON xref (pubkey, version, target_idx);"
+
+    @staticmethod
+    def parse_xrefs(note):
+        """This function splits a note such as 'See Spells; See also Combat: Actions' into a list of (kind, target)
+        tuples e.g. [('see', 'Spells'), ('see also', 'Combat: Actions')]. Parts of a note that do not start with 'See'
+        are treated as further targets of the preceding 'See' (e.g. 'See also Spells; Magic')."""
+        xrefs = []
+        kind = None
+        for part in note.split(';'):
+            match = re.match(r'^\s*see(\s+also)?\s+(.+)$', part, flags=re.IGNORECASE)
+            if match:
+                kind = 'see also' if match.group(1) else 'see'
+                target = match.group(2)
+            elif kind:
+                target = part
+            else:
+                continue
+            target = target.strip().rstrip('.').strip()
+            if target:
+                xrefs.append((kind, target))
+        return xrefs
+
+    @staticmethod
+    def refresh_xrefs(con, pubkey, version, delimiter='|'):
+        """This function resolves the 'See' notes of a pubkey/version against its own headings and entries and
+        rewrites its rows of the xref table. A target is matched to a full heading path first (with ': ' or ', '
+        accepted between levels), then to an entry text, preferring the shallowest and earliest entry. It does not
+        commit, and returns a list of (idx, target) tuples that could not be resolved."""
+        con.execute(Index.xref_sql)
+        con.execute(Index.xref_target_sql)
+        rows = con.execute("SELECT idx, entry, idx_text, notes FROM indices WHERE pubkey = ? AND version = ?;",
+                           (pubkey, version)).fetchall()
+        by_path = dict()
+        by_entry = dict()
+        for idx, entry, idx_text, notes in sorted(rows, key=lambda x: (x[0].count('.'), idx_key(x[0]))):
+            by_path.setdefault(idx_text.casefold(), idx)
+            by_entry.setdefault(entry.casefold(), idx)
+        xrefs = []
+        unresolved = []
+        for idx, entry, idx_text, notes in rows:
+            if not notes:
+                continue
+            for kind, target in Index.parse_xrefs(notes):
+                key = target.casefold()
+                target_idx = by_path.get(key) or by_path.get(re.sub(r'\s*[:,]\s+', delimiter, key)) or \
+                    by_entry.get(key)
+                if target_idx is None:
+                    unresolved.append((idx, target))
+                xrefs.append({'pubkey': pubkey, 'version': version, 'idx': idx, 'target': target, 'kind': kind,
+                              'target_idx': target_idx})
+        con.execute("DELETE FROM xref WHERE pubkey = ? AND version = ?;", (pubkey, version))
+        con.executemany("INSERT OR IGNORE INTO xref (pubkey, version, idx, target, kind, target_idx) "
+                        "VALUES (:pubkey, :version, :idx, :target, :kind, :target_idx);", xrefs)
+        return unresolved
+
+    @staticmethod
+    def xref_sources(con, pubkey, version, idx):
+        """This function returns the (idx, entry, idx_text) of every entry with a 'See' note pointing at idx."""
+        sql = '\n'.join((
+            "SELECT a.idx, a.entry, a.idx_text ",
+            "  FROM xref AS x ",
+            " INNER JOIN indices AS a ON a.pubkey = x.pubkey AND a.version = x.version AND a.idx = x.idx ",
+            " WHERE x.pubkey = ? AND x.version = ? AND x.target_idx = ? ",
+            " ORDER BY a.idx;"))
+        return con.execute(sql, (pubkey, version, idx)).fetchall()
+
+    @staticmethod
+    def last_page(page):
+        """This function returns the highest page number in a page string such as '12, 14-16' (16)."""
+        if not page:
+            return None
+        numbers = [int(x) for x in re.findall(r'\d+', page)]
+        return max(numbers) if numbers else None
+
+    @staticmethod
+    def refresh_summary(con, pubkey=None, version=None):
+        """This function recalculates the pub_summary rows of a pubkey (and optionally a single version), or of the
+        whole database if no pubkey is given, from the indices and pub tables. It does not commit, so that it can be
+        run in the same transaction as the insert or delete that made it necessary. entry_count is the number of rows
+        with pages, heading_count the number of top level rows and page_min/page_max the page span."""
+        con.create_function('last_page', 1, Index.last_page, deterministic=True)
+        # the table may also be a temporary one (see ExportForm), which creating it in main would not see
+        if not con.execute("SELECT 1 FROM sqlite_master WHERE name = 'pub_summary' UNION ALL "
+                           "SELECT 1 FROM sqlite_temp_master WHERE name = 'pub_summary';").fetchone():
+            con.execute(Index.summary_sql)
+        where = []
+        params = []
+        if pubkey is not None:
+            where.append("{0}pubkey = ?")
+            params.append(pubkey)
+        if version is not None:
+            where.append("{0}version = ?")
+            params.append(version)
+        where_text = ' AND '.join(where) if where else '1'
+        con.execute("DELETE FROM pub_summary WHERE {!s};".format(where_text.format('')), params)
+        sql = '\n'.join((
+            "INSERT INTO pub_summary (pubkey, version, title, label, entry_count, heading_count, page_min, page_max) ",
+            "SELECT a.pubkey, a.version, b.title, b.title || ' (' || a.version || ')', count(a.page), ",
+            "       sum(instr(a.idx, '.') = 0), min(CAST(a.page AS INTEGER)), max(last_page(a.page)) ",
+            "  FROM indices AS a ",
+            " INNER JOIN pub AS b ON a.pubkey = b.pubkey ",
+            " WHERE {!s} ",
+            " GROUP BY a.pubkey, a.version;")).format(where_text.format('a.'))
+        con.execute(sql, params)
+
+    def write_pub(self, c, conflict_text=''):
+        """This function inserts the pub record of the index with cursor c and returns the number of rows written."""
+        pub_sql = "INSERT {conflict} INTO pub (pubkey, author, title, abbr, edition, publisher, month, year, " \
+                  "volume, series, address, note, isbn, link, adjust) " \
+                  "VALUES (:pubkey, :author, :title, :abbr, :edition, :publisher, :month, :year, :volume, " \
+                  ":series, :address, :note, :isbn, :link, :adjust);".format(conflict=conflict_text)
+        c.execute(pub_sql, {'pubkey': self.pubkey, 'author': self.bib.get('author'),
+                            'title': self.bib.get('title'), 'abbr': self.abbr, 'edition': self.bib.get('edition'),
+                            'publisher': self.bib.get('publisher'), 'month': self.bib.get('month'),
+                            'year': self.bib.get('year'), 'volume': self.bib.get('volume'),
+                            'series': self.bib.get('series'), 'address': self.bib.get('address'),
+                            'note': self.bib.get('note'), 'isbn': self.bib.get('isbn'), 'link': self.link,
+                            'adjust': self.adjust})
+        return c.rowcount
+
+    def write_rows(self, con, rows, conflict_text=''):
+        """This function inserts index rows into the indices table, or into the node table of a normalized database,
+        and returns the number of rows written."""
+        c = con.cursor()
+        if self.is_normalized(con):
+            node_sql = "INSERT {conflict} INTO node (pubkey, version, idx, heading_id, page, notes) " \
+                       "VALUES (:pubkey, :version, :idx, :heading_id, :page, :notes);".format(conflict=conflict_text)
+            c.executemany(node_sql, self.intern_rows(con, rows))
+            index_rows = c.rowcount
+        else:
+            index_sql = "INSERT {conflict} INTO indices (pubkey, version, entry, idx, idx_text, page, notes) " \
+                        "VALUES (:pubkey, :version, :entry, :idx, :idx_text, :page, :notes);"\
+                .format(conflict=conflict_text)
+            c.executemany(index_sql, rows)
+            index_rows = c.rowcount
+        return index_rows
+
     def dict_to_db(self):
+        """This function writes the index to the database in a single transaction. The write lock is taken up front
+        (with a lock file between processes and BEGIN IMMEDIATE within sqlite), and the time spent waiting for it is
+        returned as lock_wait along with the time spent writing."""
         assert self.dbpath is not None, 'db creation requires dbpath'
         assert self.pubkey is not None, 'db creation requires pubkey'
         assert self.version is not None, 'db creation requires version'
-        if not os.path.exists(self.dbpath):
-            db_exists = False
-        else:
-            db_exists = True  # for future reference
-        self.create_db()
         if self.dict_index is None:
-            self.text_to_dict()
+            self.read_index()
         if self.df_index.empty:
             self.dict_to_df()
         df_dict = self.df_index.to_dict(orient='records')
 
-        # create a connection and insert data
-        con = sqlite.connect(self.dbpath)
-        c = con.cursor()
-        if self.conflict != 'fail':
-            conflict_text = 'OR ' + self.conflict.upper()
-        else:
-            conflict_text = ''
-        pub_sql = "INSERT {conflict} INTO pub (pubkey, author, title, abbr, edition, publisher, month, year, volume, " \
-                  "series, address, note, isbn, link, adjust) " \
-                  "VALUES (:pubkey, :author, :title, :abbr, :edition, :publisher, :month, :year, :volume, :series, " \
-                  ":address, :note, :isbn, :link, :adjust);".format(conflict=conflict_text)
-        c.execute(pub_sql, {'pubkey': self.pubkey, 'author': self.bib.get('author'), 'title': self.bib.get('title'),
-                            'abbr': self.abbr, 'edition': self.bib.get('edition'),
-                            'publisher': self.bib.get('publisher'), 'month': self.bib.get('month'),
-                            'year': self.bib.get('year'), 'volume': self.bib.get('volume'),
-                            'series': self.bib.get('series'), 'address': self.bib.get('address'),
-                            'note': self.bib.get('note'), 'isbn': self.bib.get('isbn'), 'link': self.link,
-                            'adjust': self.adjust})
-        pub_rows = c.rowcount
-        con.commit()
-        index_sql = "INSERT {conflict} INTO indices (pubkey, version, entry, idx, idx_text, page, notes) " \
-                    "VALUES (:pubkey, :version, :entry, :idx, :idx_text, :page, :notes);".format(conflict=conflict_text)
-        c.executemany(index_sql, df_dict)
-        index_rows = c.rowcount
-        con.commit()
+        with WriteLock(self.dbpath) as lock:
+            self.create_db()
+            # create a connection and insert data
+            con = sqlite.connect(self.dbpath, timeout=self.timeout)
+            try:
+                c = con.cursor()
+                start = time.perf_counter()
+                c.execute("BEGIN IMMEDIATE;")
+                lock_wait = lock.wait + time.perf_counter() - start
+                start = time.perf_counter()
+                if self.conflict != 'fail':
+                    conflict_text = 'OR ' + self.conflict.upper()
+                else:
+                    conflict_text = ''
+                pub_rows = self.write_pub(c, conflict_text)
+                index_rows = self.write_rows(con, df_dict, conflict_text)
+                unresolved = self.refresh_xrefs(con, pubkey=self.pubkey, version=self.version, delimiter=self.delimiter)
+                # all versions, as a replaced pub record may have changed the title
+                self.refresh_summary(con, pubkey=self.pubkey)
+                con.commit()
+            except Exception:
+                # releases the write lock so that later writes are not blocked by this failed one
+                con.rollback()
+                raise
+            finally:
+                con.close()
+        return {'pub_rows': pub_rows, 'index_rows': index_rows, 'unresolved': unresolved, 'lock_wait': lock_wait,
+                'write_time': time.perf_counter() - start}
+
+    def sync_db(self):
+        """This function brings the rows of this pubkey/version in the database in line with the index, e.g. after its
+        source file has been edited. The stored rows are compared with the index by idx and only the rows that were
+        added, changed or removed are written, along with the pub record, in one transaction. Returns the same metrics
+        as dict_to_db(), with index_rows counting the rows written and deleted_rows the rows removed."""
+        assert self.dbpath is not None, 'db sync requires dbpath'
+        assert self.pubkey is not None, 'db sync requires pubkey'
+        assert self.version is not None, 'db sync requires version'
+        if self.dict_index is None:
+            self.read_index()
+        if self.df_index.empty:
+            self.dict_to_df()
+        # missing values are NaN in the data frame but NULL (None) in the database
+        rows = {row['idx']: {k: None if pd.isna(v) else v for k, v in row.items()}
+                for row in self.df_index.to_dict(orient='records')}
+
+        with WriteLock(self.dbpath) as lock:
+            self.create_db()
+            con = sqlite.connect(self.dbpath, timeout=self.timeout)
+            try:
+                c = con.cursor()
+                start = time.perf_counter()
+                c.execute("BEGIN IMMEDIATE;")
+                lock_wait = lock.wait + time.perf_counter() - start
+                start = time.perf_counter()
+                pub_rows = self.write_pub(c, 'OR REPLACE')
+                old = {rec[0]: rec[1:] for rec in c.execute("SELECT idx, entry, idx_text, page, notes FROM indices "
+                                                             "WHERE pubkey = ? AND version = ?;",
+                                                             (self.pubkey, self.version))}
+                changed = [row for idx, row in rows.items()
+                           if old.get(idx) != (row['entry'], row['idx_text'], row['page'], row['notes'])]
+                removed = [(self.pubkey, self.version, idx) for idx in old if idx not in rows]
+                table = 'node' if self.is_normalized(con) else 'indices'
+                c.executemany("DELETE FROM {!s} WHERE pubkey = ? AND version = ? AND idx = ?;".format(table), removed)
+                index_rows = self.write_rows(con, changed, 'OR REPLACE') if changed else 0
+                unresolved = []
+                if changed or removed:
+                    unresolved = self.refresh_xrefs(con, pubkey=self.pubkey, version=self.version,
+                                                    delimiter=self.delimiter)
+                self.refresh_summary(con, pubkey=self.pubkey)
+                con.commit()
+            except Exception:
+                # releases the write lock so that later writes are not blocked by this failed one
+                con.rollback()
+                raise
+            finally:
+                con.close()
+        return {'pub_rows': pub_rows, 'index_rows': index_rows, 'deleted_rows': len(removed),
+                'unresolved': unresolved, 'lock_wait': lock_wait, 'write_time': time.perf_counter() - start}
+
+    def delete_db(self):
+        """This function deletes the rows of this pubkey/version from the indices table."""
+        assert self.dbpath is not None, 'db deletion requires dbpath'
+        assert self.pubkey is not None, 'db deletion requires pubkey'
+        assert self.version is not None, 'db deletion requires version'
+        with WriteLock(self.dbpath):
+            self.create_db()
+            con = sqlite.connect(self.dbpath, timeout=self.timeout)
+            try:
+                c = con.cursor()
+                c.execute("BEGIN IMMEDIATE;")
+                # headings and labels are shared between publications, so only the nodes are deleted
+                table = 'node' if self.is_normalized(con) else 'indices'
+                c.execute("DELETE FROM {!s} WHERE pubkey = ? AND version = ?;".format(table),
+                          (self.pubkey, self.version))
+                index_rows = c.rowcount
+                c.execute("DELETE FROM xref WHERE pubkey = ? AND version = ?;", (self.pubkey, self.version))
+                self.refresh_summary(con, pubkey=self.pubkey, version=self.version)
+                con.commit()
+            except Exception:
+                # releases the write lock so that later writes are not blocked by this failed one
+                con.rollback()
+                raise
+            finally:
+                con.close()
+        return index_rows
+
+
+class IndexWriter:
+    """
+    This class writes Index objects to one database from a single background thread, so that any number of producer
+    threads can parse indices and submit() them without contending for the database. Writes from other processes are
+    kept in turn by the lock file used in Index.dict_to_db(). close() waits for the queue to empty and returns
+    throughput and lock wait metrics.
+    """
+
+    def __init__(self, dbpath, timeout=60, maxsize=0, wal=False):
+        self.dbpath = dbpath  # the path to the sqlite database all indices are written to
+        self.timeout = timeout  # seconds each write waits for another connection's write lock
+        self.wal = wal  # switch the database to write-ahead logging
+        self.queue = queue.Queue(maxsize=maxsize)  # parsed Index objects waiting to be written
+        self.metrics = {'indices': 0, 'rows': 0, 'errors': 0, 'lock_wait': 0.0, 'lock_wait_max': 0.0,
+                        'write_time': 0.0}
+        self.errors = []  # (pubkey, version, repr of the exception) of failed writes
+        self.start_time = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, index):
+        self.queue.put(index)
+
+    def run(self):
+        while True:
+            index = self.queue.get()
+            if index is None:
+                break
+            index.dbpath = self.dbpath
+            index.timeout = self.timeout
+            index.wal = self.wal
+            try:
+                rows = index.dict_to_db()
+            # any failure (e.g. a missing or malformed index file) is recorded so the thread keeps going
+            except Exception as e:
+                self.metrics['errors'] += 1
+                # kept as text, as the exception's traceback would keep its frames (and connections) alive
+                self.errors.append((index.pubkey, index.version, repr(e)))
+                continue
+            self.metrics['indices'] += 1
+            self.metrics['rows'] += rows['index_rows']
+            self.metrics['lock_wait'] += rows['lock_wait']
+            self.metrics['lock_wait_max'] = max(self.metrics['lock_wait_max'], rows['lock_wait'])
+            self.metrics['write_time'] += rows['write_time']
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        elapsed = time.perf_counter() - self.start_time
+        self.metrics['elapsed'] = elapsed
+        self.metrics['rows_per_sec'] = self.metrics['rows'] / elapsed if elapsed else 0.0
+        return self.metrics
+
+
+class Bibliography:
+    """
+    This class stores BibTeX entries in a 'bib' table of a sqlite database, keyed by the BibTeX ID, so that single
+    entries can be looked up and upserted without reparsing or rewriting a whole .bib file. A .bib file is only parsed
+    again when its modification time or size has changed since it was last loaded, and is only written by export_bib().
+    The bib_member table records which entries each .bib file holds, so that entries removed from a file are dropped
+    from the store and a file is exported with its own entries only. Entries upserted for a file but not yet exported
+    to it are kept as pending. Writes take the same WriteLock as Index, as the bib table may share a database with
+    indices being imported by other processes.
+    """
+
+    def __init__(self, dbpath, timeout=60):
+        self.dbpath = dbpath  # the path to the sqlite database holding the bib table
+        self.timeout = timeout  # seconds to wait for another connection's write lock before failing
+        self.create_db()
+
+    def write(self, func):
+        """This function calls func with a connection to the database while holding the write lock, and commits its
+        changes in one transaction (or rolls them back if it fails)."""
+        with WriteLock(self.dbpath):
+            con = sqlite.connect(self.dbpath, timeout=self.timeout)
+            try:
+                con.execute("BEGIN IMMEDIATE;")
+                func(con)
+                con.commit()
+            except Exception:
+                con.rollback()
+                raise
+            finally:
+                con.close()
+
+    def create_db(self):
+        sql_list = [
+            "CREATE TABLE IF NOT EXISTS bib (id TEXT PRIMARY KEY, entrytype TEXT, fields TEXT);",
+            "CREATE TABLE IF NOT EXISTS bib_source (path TEXT PRIMARY KEY, mtime REAL, size INTEGER);",
+            "CREATE TABLE IF NOT EXISTS bib_member (path TEXT, id TEXT, pending INTEGER DEFAULT (0), "
+            "PRIMARY KEY (path, id));",
+            "CREATE INDEX IF NOT EXISTS bib_member_id ON bib_member (id);"
+        ]
+
+        def store(con):
+            for sql in sql_list:
+                con.execute(sql)
+        self.write(store)
+
+    @staticmethod
+    def entry_to_row(bib):
+        """This function splits a bibtexparser style entry into its ID, entry type and a JSON string of its fields."""
+        fields = {k: str(v) for k, v in bib.items() if k not in ('ID', 'ENTRYTYPE') and v}
+        return {'id': bib['ID'], 'entrytype': bib.get('ENTRYTYPE', 'misc'),
+                'fields': json.dumps(fields, ensure_ascii=False, sort_keys=True)}
+
+    @staticmethod
+    def row_to_entry(row):
+        """This function converts a (id, entrytype, fields) row from the bib table back into a bibtexparser entry."""
+        entry = json.loads(row[2])
+        entry['ENTRYTYPE'] = row[1]
+        entry['ID'] = row[0]
+        return entry
+
+    def load_bib(self, bib_path, force=False):
+        """This function parses a .bib file into the bib table if it has changed since it was last loaded. Entries
+        that were in the file when it was last loaded but no longer are, and are not in any other file, are deleted.
+        Returns the number of entries loaded (0 if the stored copy was still current)."""
+        stat = os.stat(bib_path)
+        path = os.path.abspath(bib_path)
+        if not force:
+            con = sqlite.connect(self.dbpath, timeout=self.timeout)
+            rec = con.execute("SELECT mtime, size FROM bib_source WHERE path = ?;", (path,)).fetchone()
+            con.close()
+            if rec and rec[0] == stat.st_mtime and rec[1] == stat.st_size:
+                return 0
+        with open(bib_path) as bibtex_file:
+            bib_database = bibtexparser.load(bibtex_file)
+        rows = [self.entry_to_row(x) for x in bib_database.entries]
+
+        def store(con):
+            old_ids = [row[0] for row in con.execute("SELECT id FROM bib_member WHERE path = ?;", (path,))]
+            con.execute("DELETE FROM bib_member WHERE path = ? AND NOT pending;", (path,))
+            con.executemany("INSERT OR IGNORE INTO bib_member (path, id) VALUES (?, ?);",
+                            [(path, x['id']) for x in rows])
+            con.executemany("DELETE FROM bib WHERE id = ? AND NOT EXISTS (SELECT 1 FROM bib_member WHERE id = ?);",
+                            [(x, x) for x in old_ids])
+            con.executemany("INSERT OR REPLACE INTO bib (id, entrytype, fields) VALUES (:id, :entrytype, :fields);",
+                            rows)
+            con.execute("INSERT OR REPLACE INTO bib_source (path, mtime, size) VALUES (?, ?, ?);",
+                        (path, stat.st_mtime, stat.st_size))
+        self.write(store)
+        return len(rows)
+
+    def get(self, bib_id):
+        """This function returns the entry for bib_id as a dictionary, or None if it is not stored."""
+        con = sqlite.connect(self.dbpath, timeout=self.timeout)
+        row = con.execute("SELECT id, entrytype, fields FROM bib WHERE id = ?;", (bib_id,)).fetchone()
         con.close()
-        return {'pub_rows': pub_rows, 'index_rows': index_rows}
+        if row is None:
+            return None
+        return self.row_to_entry(row)
+
+    def upsert(self, bib, bib_path=None):
+        """This function inserts the entry, or replaces the stored entry with the same ID, and records it as an entry
+        of the .bib file at bib_path if given."""
+        def store(con):
+            con.execute("INSERT OR REPLACE INTO bib (id, entrytype, fields) VALUES (:id, :entrytype, :fields);",
+                        self.entry_to_row(bib))
+            if bib_path is not None:
+                con.execute("INSERT OR REPLACE INTO bib_member (path, id, pending) VALUES (?, ?, 1);",
+                            (os.path.abspath(bib_path), bib['ID']))
+        self.write(store)
+
+    def export_bib(self, out_file):
+        """This function writes the stored entries of a .bib file (those loaded from it or upserted for it) to the
+        file in one pass, ordered by ID. Returns the number of entries written."""
+        con = sqlite.connect(self.dbpath, timeout=self.timeout)
+        sql = '\n'.join((
+            "SELECT b.id, b.entrytype, b.fields ",
+            "  FROM bib_member AS m ",
+            " INNER JOIN bib AS b ON b.id = m.id ",
+            " WHERE m.path = ? ",
+            " ORDER BY b.id;"))
+        result = con.execute(sql, (os.path.abspath(out_file),))
+        db = BibDatabase()
+        db.entries = [self.row_to_entry(row) for row in result]
+        con.close()
+        writer = BibTexWriter()
+        writer.order_entries_by = None
+        with open(out_file, 'w') as bibfile:
+            bibfile.write(writer.write(db))
+        # the exported file is now identical to the store, so it does not need to be parsed again
+        if os.path.isfile(out_file):
+            stat = os.stat(out_file)
+            path = os.path.abspath(out_file)
+
+            def store(con):
+                con.execute("INSERT OR REPLACE INTO bib_source (path, mtime, size) VALUES (?, ?, ?);",
+                            (path, stat.st_mtime, stat.st_size))
+                con.execute("UPDATE bib_member SET pending = 0 WHERE path = ?;", (path,))
+            self.write(store)
+        return len(db.entries)
+
+
+class PrefixIndex:
+    """
+    This class holds a case-folded, sorted array of search keys for type-ahead lookups. Each value can have several
+    keys (e.g. every sub-heading of a heading path), and a lookup returns the values with a key starting with the text,
+    in the order the values were given. Lookups use bisect, and a lookup for text that extends the previous one only
+    searches within the previous result range.
+    """
+
+    def __init__(self, values, keys_func):
+        self.values = values  # the values to return, in display order
+        pairs = sorted((key.casefold(), i) for i, value in enumerate(values) for key in keys_func(value))
+        self.keys = [x[0] for x in pairs]  # the sorted search keys
+        self.ids = array('l', [x[1] for x in pairs])  # the position in values of each key
+        self.last = ('', 0, len(self.keys))  # the previous prefix and its range in keys
+
+    def search(self, text):
+        prefix = text.casefold()
+        last_prefix, lo, hi = self.last
+        if not prefix.startswith(last_prefix):
+            lo, hi = 0, len(self.keys)
+        lo = bisect_left(self.keys, prefix, lo, hi)
+        hi = bisect_left(self.keys, prefix + '\U0010ffff', lo, hi)
+        self.last = (prefix, lo, hi)
+        return [self.values[i] for i in sorted(set(self.ids[lo:hi]))]
+
+
+class QueryTracer:
+    """
+    This class times the queries that ExportForm issues when passed to it, along with the number of rows each returns
+    and the time spent inserting them into the list boxes. Queries are grouped by kind (e.g. 'headings' or 'entries')
+    with a histogram of their times per kind. Any query slower than threshold seconds is kept in a slow query log
+    together with its EXPLAIN QUERY PLAN output. to_dict() and export() return or write everything as JSON.
+    """
+
+    bounds = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5]  # histogram bucket upper bounds (s)
+
+    def __init__(self, threshold=0.1, echo=True):
+        self.threshold = threshold  # seconds above which a query is added to the slow query log
+        self.echo = echo  # print each slow query as it is logged
+        self.kinds = dict()  # kind: the timings of that kind of query
+        self.slow = []  # the slow query log
+
+    def stats(self, kind):
+        if kind not in self.kinds:
+            self.kinds[kind] = {'count': 0, 'rows': 0, 'time': 0.0, 'max_time': 0.0, 'inserts': 0,
+                                'insert_time': 0.0, 'histogram': [0] * (len(self.bounds) + 1)}
+        return self.kinds[kind]
+
+    def execute(self, conn, kind, sql, params=()):
+        """This function runs a query on conn, fetches all of its rows and records its time and row count under kind.
+        Returns the rows."""
+        start = time.perf_counter()
+        rows = conn.execute(sql, params).fetchall()
+        seconds = time.perf_counter() - start
+        stats = self.stats(kind)
+        stats['count'] += 1
+        stats['rows'] += len(rows)
+        stats['time'] += seconds
+        stats['max_time'] = max(stats['max_time'], seconds)
+        stats['histogram'][bisect_left(self.bounds, seconds)] += 1
+        if seconds > self.threshold:
+            self.log_slow(conn, kind, sql, params, seconds, len(rows))
+        return rows
+
+    def log_slow(self, conn, kind, sql, params, seconds, rows):
+        # the plan is indented by its depth in the tree, as in the sqlite3 shell
+        depth = {0: -1}
+        plan = []
+        for node_id, parent, notused, detail in conn.execute('EXPLAIN QUERY PLAN ' + sql, params):
+            depth[node_id] = depth.get(parent, -1) + 1
+            plan.append('  ' * depth[node_id] + detail)
+        self.slow.append({'kind': kind, 'time': seconds, 'rows': rows, 'sql': sql, 'params': list(params),
+                          'plan': plan, 'at': time.time()})
+        if self.echo:
+            print('slow {!s} query: {:.3f}s, {!s} rows'.format(kind, seconds, rows))
+            print('\n'.join(plan))
+
+    def inserted(self, kind, seconds, count):
+        """This function records the time spent inserting count rows of a kind of query into a list box."""
+        stats = self.stats(kind)
+        stats['inserts'] += count
+        stats['insert_time'] += seconds
+
+    def to_dict(self):
+        labels = ['<={!s}ms'.format(round(x * 1000)) for x in self.bounds] + \
+                 ['>{!s}ms'.format(round(self.bounds[-1] * 1000))]
+        kinds = dict()
+        for kind, stats in sorted(self.kinds.items()):
+            kinds[kind] = dict(stats, mean_time=stats['time'] / stats['count'] if stats['count'] else None,
+                               histogram=dict(zip(labels, stats['histogram'])))
+        return {'threshold': self.threshold, 'kinds': kinds, 'slow': self.slow}
+
+    def export(self, out_file):
+        with open(out_file, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=4)
 
 
 class ExportForm:
-    def __init__(self, master, conn, scrptdir):
+    def __init__(self, master, conn, scrptdir, tracer=None, delimiter='|'):
         self.master = master
         # self.cframe = Frame(self.master)
         # self.cframe.grid(row=0, column=0, sticky='nsew')
@@ -256,6 +986,15 @@ class ExportForm:
         self.sv_pub = StringVar()
         self.sv_idx = StringVar()
         self.sv_ent = StringVar()
+        self.headings = []  # the headings listed for the selected publications
+        self.headingIds = dict()  # path: heading id of the listed headings, in a normalized database
+        self.headingPaths = dict()  # heading id: (path, label) of the listed headings, in a normalized database
+        self.valueHeading = []  # the heading ids of the selected headings, in a normalized database
+        self.prefixIndex = None  # PrefixIndex of the headings, built on the first keystroke in the heading filter
+        self.prefixEntry = None  # PrefixIndex of the entries (False if there are too many), built the same way
+        self.prefix_limit = 100000  # the most headings or entry rows to hold in memory for the filters
+        self.tracer = tracer  # an optional QueryTracer that times the queries and list box inserts
+        self.delimiter = delimiter  # the delimiter between the categories of idx_text (see Index)
 
         with open(os.path.join(scrptdir, 'pdf_options.json'), 'r') as f:
             pdf_options = json.load(f)
@@ -388,16 +1127,49 @@ class ExportForm:
         self.master.grid_rowconfigure(3, weight=0)
         self.master.grid_rowconfigure(4, weight=0)
 
+        self.normalized = Index.is_normalized(conn)  # whether the database uses the heading/node schema
+        # the distinct headings of the selected publications that have pages, whose paths make up the heading list
+        self.heading_ids_sql = '\n'.join((
+            "SELECT DISTINCT n.heading_id ",
+            "  FROM pub_summary AS s ",
+            " INNER JOIN node AS n ON n.pubkey = s.pubkey AND n.version = s.version ",
+            " WHERE s.label IN ({!s}) ",
+            "   AND n.page IS NOT NULL"))
+
+        # databases created before the pub_summary table existed get it built once here
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'pub_summary';").fetchone():
+            try:
+                Index.refresh_summary(conn)
+                conn.commit()
+            except sqlite.OperationalError:
+                # a read-only or locked database gets the summary in a temporary table for this session instead
+                conn.rollback()
+                conn.execute(Index.summary_sql.replace('CREATE TABLE', 'CREATE TEMP TABLE'))
+                Index.refresh_summary(conn)
+                conn.commit()
+
+        # runs the queries of the form, through the tracer when there is one
+        def run(kind, sql, params=()):
+            if self.tracer is None:
+                return conn.execute(sql, params).fetchall()
+            return self.tracer.execute(conn, kind, sql, params)
+
+        # inserts the text items into a list box, timing them under the kind of query they came from when tracing
+        def fill(listbox, kind, items):
+            start = time.perf_counter()
+            count = 0
+            for item in items:
+                listbox.insert(END, item)
+                count += 1
+            if self.tracer is not None:
+                self.tracer.inserted(kind, time.perf_counter() - start, count)
+
         init_sql = '\n'.join((
-            "SELECT b.title || ' (' || a.version || ')' ",
-            "  FROM indices as a ",
-            " INNER JOIN pub AS b ON a.pubkey = b.pubkey ",
-            " WHERE a.page IS NOT NULL ",
-            " GROUP BY b.title, a.version ",
-            " ORDER BY b.title, a.version;"))
-        pub_result = conn.execute(init_sql)
-        for row in pub_result:
-            self.lstPub.insert(END, row[0])
+            "SELECT label ",
+            "  FROM pub_summary ",
+            " WHERE entry_count > 0 ",
+            " ORDER BY title, version;"))
+        fill(self.lstPub, 'pubs', (row[0] for row in run('pubs', init_sql)))
 
         # self.btnSelectAll_pub.invoke()
         # idx_result = conn.execute("SELECT idx_text FROM indices WHERE page IS NOT NULL "
@@ -419,22 +1191,55 @@ class ExportForm:
                 value.append(w.get(c[i]))
             # print(value)
             self.valuePub = value
+            self.prefixIndex = None
+            self.prefixEntry = None
+            if self.normalized:
+                # the paths are built from the listed headings and their parents, each read once
+                s = Index.heading_tree_sql.format(ids=self.heading_ids_sql.format(','.join('?' * len(self.valuePub))))
+                self.headingPaths = Index.heading_paths(run('headings', s, self.valuePub * 2), self.delimiter)
+                self.headingIds = {v[0]: k for k, v in self.headingPaths.items()}
+                headings = sorted(self.headingIds, key=str.lower)
+            else:
+                s = '\n'.join((
+                    "SELECT idx_text FROM indices AS a ",
+                    " INNER JOIN pub AS b ON a.pubkey = b.pubkey ",
+                    " WHERE b.title || ' (' || a.version || ')' IN ({!s}) ",
+                    "   AND a.page IS NOT NULL ",
+                    " GROUP BY a.idx_text ",
+                    " ORDER BY lower(a.idx_text);"))\
+                    .format(','.join('?' * len(self.valuePub)))
+                headings = [row[0] for row in run('headings', s, self.valuePub)]
+            self.headings = headings
+            fill(self.lstIndex, 'headings', headings)
+            if len(headings) == 1:
+                self.lstIndex.selection_set(0)
+                self.lstIndex.event_generate("<<ListboxSelect>>")
+
+        def load_entries(conn):
+            """Loads the entries of the selected publications into a PrefixIndex for the entry filter, unless there
+            are more than prefix_limit of them, in which case prefixEntry is set to False and the filter queries the
+            database."""
+            self.prefixEntry = False
             s = '\n'.join((
-                "SELECT idx_text FROM indices AS a ",
-                " INNER JOIN pub AS b ON a.pubkey = b.pubkey ",
-                " WHERE b.title || ' (' || a.version || ')' IN ({!s}) ",
+                "SELECT a.idx_text, a.entry, a.notes, a.idx ",
+                "  FROM pub_summary AS s ",
+                " INNER JOIN indices AS a ON a.pubkey = s.pubkey AND a.version = s.version ",
+                " WHERE s.label IN ({!s}) ",
                 "   AND a.page IS NOT NULL ",
-                " GROUP BY a.idx_text ",
-                " ORDER BY lower(a.idx_text);"))\
+                " LIMIT ?;"))\
                 .format(','.join('?' * len(self.valuePub)))
-            result = conn.execute(s, self.valuePub)
-            count = 0
-            for row in result:
-                count += 1
-                self.lstIndex.insert(END, row[0])
-            if count == 1:
-                self.lstIndex.selection_set(0)
-                self.lstIndex.event_generate("<<ListboxSelect>>")
+            if self.normalized:
+                # reads heading ids, as the path of each distinct heading is already known from the heading list
+                s = s.replace("a.idx_text, a.entry, a.notes, a.idx", "a.heading_id, NULL, a.notes, a.idx")\
+                    .replace("indices AS a", "node AS a")
+            rows = run('prefix_entries', s, self.valuePub + [self.prefix_limit + 1])
+            if len(rows) > self.prefix_limit:
+                return
+            if self.normalized:
+                # the rows are those of the listed headings, whose paths were read with the heading list
+                rows = [self.headingPaths[row[0]] + row[2:] for row in rows]
+            entries = sorted(set((row[1], row[2], row[0], row[3]) for row in rows), key=lambda x: x[3])
+            self.prefixEntry = PrefixIndex(entries, lambda x: [x[0]])
 
         def onselect_Index(evt):
             self.lstEntry.delete(0, END)
@@ -447,24 +1252,35 @@ class ExportForm:
                 value.append(w.get(c[i]))
             # print(value)
             self.valueIndex = value
-            s = '\n'.join((
-                "SELECT a.entry, a.notes ",
-                "  FROM indices AS a ",
-                " INNER JOIN pub AS b ON a.pubkey = b.pubkey ",
-                " WHERE a.idx_text IN ({!s}) ",
-                "   AND b.title || ' (' || a.version || ')' IN ({!s}) ",
-                "   AND a.page IS NOT NULL ",
-                " GROUP BY a.entry ORDER BY a.idx;"))\
-                .format(','.join('?' * len(self.valueIndex)), ','.join('?' * len(self.valuePub)))
-            result = conn.execute(s, self.valueIndex + self.valuePub)
-            count = 0
-            for row in result:
-                count += 1
-                if not row[1]:
-                    self.lstEntry.insert(END, row[0])
-                else:
-                    self.lstEntry.insert(END, ''.join((row[0], ' | (', row[1], ')')))
-            if count == 1:
+            if self.normalized:
+                # the node rows of the selected headings are matched by the heading ids read with the heading list
+                self.valueHeading = [self.headingIds[x] for x in self.valueIndex if x in self.headingIds]
+                s = '\n'.join((
+                    "SELECT l.text, n.notes ",
+                    "  FROM pub_summary AS s ",
+                    " INNER JOIN node AS n ON n.pubkey = s.pubkey AND n.version = s.version ",
+                    " INNER JOIN heading AS h ON h.id = n.heading_id ",
+                    " INNER JOIN label AS l ON l.id = h.label_id ",
+                    " WHERE n.heading_id IN ({!s}) ",
+                    "   AND s.label IN ({!s}) ",
+                    "   AND n.page IS NOT NULL ",
+                    " GROUP BY l.text ORDER BY n.idx;"))\
+                    .format(','.join('?' * len(self.valueHeading)), ','.join('?' * len(self.valuePub)))
+                result = run('entries', s, self.valueHeading + self.valuePub)
+            else:
+                s = '\n'.join((
+                    "SELECT a.entry, a.notes ",
+                    "  FROM indices AS a ",
+                    " INNER JOIN pub AS b ON a.pubkey = b.pubkey ",
+                    " WHERE a.idx_text IN ({!s}) ",
+                    "   AND b.title || ' (' || a.version || ')' IN ({!s}) ",
+                    "   AND a.page IS NOT NULL ",
+                    " GROUP BY a.entry ORDER BY a.idx;"))\
+                    .format(','.join('?' * len(self.valueIndex)), ','.join('?' * len(self.valuePub)))
+                result = run('entries', s, self.valueIndex + self.valuePub)
+            fill(self.lstEntry, 'entries', (row[0] if not row[1] else ''.join((row[0], ' | (', row[1], ')'))
+                                            for row in result))
+            if len(result) == 1:
                 self.lstEntry.selection_set(0)
                 self.lstEntry.event_generate("<<ListboxSelect>>")
 
@@ -478,25 +1294,37 @@ class ExportForm:
                 value.append(w.get(c[i]).split('|')[0].strip())
             # print(value)
             self.valueEntry = value
-            s = '\n'.join((
-                "SELECT a.pubkey, a.page ",
-                "  FROM indices AS a ",
-                " INNER JOIN pub AS b ON a.pubkey = b.pubkey ",
-                " WHERE a.entry IN ({!s}) ",
-                "   AND a.idx_text IN ({!s}) ",
-                "   AND b.title || ' (' || a.version || ')' IN ({!s}) ",
-                "   AND a.page IS NOT NULL ",
-                " GROUP BY a.pubkey, a.page ",
-                " ORDER BY a.pubkey, a.page;"))\
-                .format(','.join('?' * len(self.valueEntry)), ','.join('?' * len(self.valueIndex)),
-                        ','.join('?' * len(self.valuePub)))
-            result = conn.execute(s, self.valueEntry + self.valueIndex + self.valuePub)
-            count = 0
-            for row in result:
-                pages = [x.strip() for x in row[1].split(',')]
-                for p in pages:
-                    count += 1
-                    self.lstPages.insert(END, ' | '.join((row[0], p)))
+            if self.normalized:
+                s = '\n'.join((
+                    "SELECT n.pubkey, n.page ",
+                    "  FROM pub_summary AS s ",
+                    " INNER JOIN node AS n ON n.pubkey = s.pubkey AND n.version = s.version ",
+                    " INNER JOIN heading AS h ON h.id = n.heading_id ",
+                    " INNER JOIN label AS l ON l.id = h.label_id ",
+                    " WHERE l.text IN ({!s}) ",
+                    "   AND n.heading_id IN ({!s}) ",
+                    "   AND s.label IN ({!s}) ",
+                    "   AND n.page IS NOT NULL ",
+                    " GROUP BY n.pubkey, n.page ",
+                    " ORDER BY n.pubkey, n.page;"))\
+                    .format(','.join('?' * len(self.valueEntry)), ','.join('?' * len(self.valueHeading)),
+                            ','.join('?' * len(self.valuePub)))
+                result = run('pages', s, self.valueEntry + self.valueHeading + self.valuePub)
+            else:
+                s = '\n'.join((
+                    "SELECT a.pubkey, a.page ",
+                    "  FROM indices AS a ",
+                    " INNER JOIN pub AS b ON a.pubkey = b.pubkey ",
+                    " WHERE a.entry IN ({!s}) ",
+                    "   AND a.idx_text IN ({!s}) ",
+                    "   AND b.title || ' (' || a.version || ')' IN ({!s}) ",
+                    "   AND a.page IS NOT NULL ",
+                    " GROUP BY a.pubkey, a.page ",
+                    " ORDER BY a.pubkey, a.page;"))\
+                    .format(','.join('?' * len(self.valueEntry)), ','.join('?' * len(self.valueIndex)),
+                            ','.join('?' * len(self.valuePub)))
+                result = run('pages', s, self.valueEntry + self.valueIndex + self.valuePub)
+            fill(self.lstPages, 'pages', (' | '.join((row[0], p.strip())) for row in result for p in row[1].split(',')))
             # if count == 1:
             #     self.lstPages.selection_set(0)
             #     self.lstPages.event_generate("<<ListboxSelect>>")
@@ -512,7 +1340,7 @@ class ExportForm:
             self.valuePages = value
             for i in self.valuePages:
                 pg = int(i[1].split('-')[0])
-                rec = conn.execute("SELECT link, adjust FROM pub WHERE pubkey = ?;", (i[0],)).fetchone()
+                rec = run('link', "SELECT link, adjust FROM pub WHERE pubkey = ?;", (i[0],))[0]
                 pdf_path = rec[0]
                 pg += int(rec[1])
             if self.pdf and pdf_path:
@@ -521,6 +1349,77 @@ class ExportForm:
                 cmd_list = shlex.split(command)
                 process = subprocess.Popen(cmd_list, shell=False,  stdout=subprocess.PIPE)
 
+        # jumps from an entry with a 'See' note to the heading and entry it refers to
+        def onfollow_Entry(evt):
+            w = evt.widget
+            i = w.nearest(evt.y)
+            if i < 0:
+                return
+            entry = w.get(i).split('|')[0].strip()
+            if self.normalized:
+                # the heading of the target row, whose path and label are the heading and entry to jump to (the
+                # query is used twice by heading_tree_sql, hence the parameters twice over)
+                target = '\n'.join((
+                    "SELECT t.heading_id ",
+                    "  FROM pub_summary AS s ",
+                    " INNER JOIN node AS a ON a.pubkey = s.pubkey AND a.version = s.version ",
+                    " INNER JOIN heading AS h ON h.id = a.heading_id ",
+                    " INNER JOIN label AS l ON l.id = h.label_id ",
+                    " INNER JOIN xref AS x ON x.pubkey = a.pubkey AND x.version = a.version AND x.idx = a.idx ",
+                    " INNER JOIN node AS t ON t.pubkey = x.pubkey AND t.version = x.version "
+                    "AND t.idx = x.target_idx ",
+                    " WHERE s.label IN ({!s}) ",
+                    "   AND l.text = ? ",
+                    "   AND (a.heading_id IN ({!s}) OR ?) ",
+                    " ORDER BY x.kind, t.idx ",
+                    " LIMIT 1"))\
+                    .format(','.join('?' * len(self.valuePub)), ','.join('?' * len(self.valueHeading)))
+                s = Index.heading_tree_sql.format(ids=target)
+                params = (self.valuePub + [entry] + self.valueHeading + [not self.valueIndex]) * 2
+            else:
+                s = '\n'.join((
+                    "SELECT t.idx_text, t.entry ",
+                    "  FROM pub_summary AS s ",
+                    " INNER JOIN indices AS a ON a.pubkey = s.pubkey AND a.version = s.version ",
+                    " INNER JOIN xref AS x ON x.pubkey = a.pubkey AND x.version = a.version AND x.idx = a.idx ",
+                    " INNER JOIN indices AS t ON t.pubkey = x.pubkey AND t.version = x.version "
+                    "AND t.idx = x.target_idx ",
+                    " WHERE s.label IN ({!s}) ",
+                    "   AND a.entry = ? ",
+                    "   AND (a.idx_text IN ({!s}) OR ?) ",
+                    " ORDER BY x.kind, t.idx ",
+                    " LIMIT 1;"))\
+                    .format(','.join('?' * len(self.valuePub)), ','.join('?' * len(self.valueIndex)))
+                params = self.valuePub + [entry] + self.valueIndex + [not self.valueIndex]
+            try:
+                rec = run('xref', s, params)
+            except sqlite.OperationalError:  # databases created before the xref table existed
+                rec = None
+            if rec and self.normalized:
+                rec = list(Index.heading_paths(rec, self.delimiter).values())
+            rec = rec[0] if rec else None
+            if rec is None:
+                return
+            self.sv_idx.set('')
+            headings = self.lstIndex.get(0, END)
+            if rec[0] not in headings:
+                # headings without pages of their own (e.g. a category) are not listed, so the heading list is
+                # filtered to the subtree of the target instead
+                self.sv_idx.set(rec[0])
+                return
+            i = headings.index(rec[0])
+            self.lstIndex.selection_clear(0, END)
+            self.lstIndex.selection_set(i)
+            self.lstIndex.see(i)
+            self.lstIndex.event_generate("<<ListboxSelect>>")
+            entries = [x.split('|')[0].strip() for x in self.lstEntry.get(0, END)]
+            if rec[1] in entries and len(entries) > 1:
+                i = entries.index(rec[1])
+                self.lstEntry.selection_clear(0, END)
+                self.lstEntry.selection_set(i)
+                self.lstEntry.see(i)
+                self.lstEntry.event_generate("<<ListboxSelect>>")
+
         # callback actions if text boxes have been altered
         def callback_pub(sv):
             self.lstPub.delete(0, END)
@@ -531,26 +1430,15 @@ class ExportForm:
             cb = sv.get()
             if cb:
                 sql = '\n'.join((
-                    "SELECT b.title || ' (' || a.version || ')' ",
-                    "  FROM indices as a ",
-                    " INNER JOIN pub AS b ON a.pubkey = b.pubkey ",
-                    " WHERE a.page IS NOT NULL ",
-                    " GROUP BY b.title, a.version ",
-                    "HAVING lower(b.title || ' (' || a.version || ')') LIKE '%{!s}%' ",
-                    " ORDER BY b.title, a.version;"))\
-                    .format(cb)
-                result = conn.execute(sql)
+                    "SELECT label ",
+                    "  FROM pub_summary ",
+                    " WHERE entry_count > 0 ",
+                    "   AND lower(label) LIKE ? ",
+                    " ORDER BY title, version;"))
+                result = run('pub_filter', sql, ('%' + cb.lower() + '%',))
             else:
-                sql = '\n'.join((
-                    "SELECT b.title || ' (' || a.version || ')' ",
-                    "  FROM indices as a ",
-                    " INNER JOIN pub AS b ON a.pubkey = b.pubkey ",
-                    " WHERE a.page IS NOT NULL ",
-                    " GROUP BY b.title, a.version ",
-                    " ORDER BY b.title, a.version;"))
-                result = conn.execute(sql)
-            for row in result:
-                self.lstPub.insert(END, row[0])
+                result = run('pubs', init_sql)
+            fill(self.lstPub, 'pub_filter' if cb else 'pubs', (row[0] for row in result))
 
         def callback_idx(sv):
             self.lstIndex.delete(0, END)
@@ -558,18 +1446,18 @@ class ExportForm:
             self.lstEntry.delete(0, END)
             self.lstPages.delete(0, END)
             cb = sv.get()
-            if cb:
-                sql = '\n'.join((
-                    "SELECT idx_text ",
-                    "  FROM indices as a ",
-                    " INNER JOIN pub AS b ON a.pubkey = b.pubkey ",
-                    " WHERE a.page IS NOT NULL ",
-                    "   AND b.title || ' (' || a.version || ')' IN ({!s}) ",
-                    " GROUP BY a.idx_text, a.idx ",
-                    "HAVING idx_text LIKE '%{!s}%' ",
-                    "ORDER BY lower(idx_text);"))\
-                    .format(','.join('?' * len(self.valuePub)), cb)
-                result = conn.execute(sql, self.valuePub)
+            if self.prefixIndex is None and len(self.headings) <= self.prefix_limit:
+                # built from the listed headings, as a heading path can be found by the start of any of its
+                # sub-headings
+                d = self.delimiter
+                self.prefixIndex = PrefixIndex(self.headings, lambda x: [d.join(x.split(d)[i:])
+                                                                         for i in range(x.count(d) + 1)])
+            if self.prefixIndex is not None:
+                headings = self.prefixIndex.search(cb)
+            elif self.normalized:
+                # the paths are not stored, so the listed headings are searched instead
+                cb = cb.lower()
+                headings = [x for x in self.headings if x.lower().startswith(cb) or self.delimiter + cb in x.lower()]
             else:
                 sql = '\n'.join((
                     "SELECT idx_text ",
@@ -577,31 +1465,45 @@ class ExportForm:
                     " INNER JOIN pub AS b ON a.pubkey = b.pubkey ",
                     " WHERE a.page IS NOT NULL ",
                     "   AND b.title || ' (' || a.version || ')' IN ({!s}) ",
-                    " GROUP BY a.idx_text, a.idx ",
+                    "   AND (lower(idx_text) LIKE ? OR lower(idx_text) LIKE ?) ",
+                    " GROUP BY a.idx_text ",
                     " ORDER BY lower(idx_text);"))\
                     .format(','.join('?' * len(self.valuePub)))
-                result = conn.execute(sql, self.valuePub)
-            for row in result:
-                self.lstIndex.insert(END, row[0])
+                result = run('heading_filter', sql,
+                             self.valuePub + [cb.lower() + '%', '%' + self.delimiter + cb.lower() + '%'])
+                headings = [row[0] for row in result]
+            fill(self.lstIndex, 'heading_filter', headings)
 
         def callback_ent(sv):
             self.lstEntry.delete(0, END)
             # print(cb, type(cb))
             self.lstPages.delete(0, END)
             cb = sv.get()
-            if cb:
+            if self.prefixEntry is None:
+                load_entries(conn)
+            if self.prefixEntry:
+                selected = set(self.valueIndex)
+                entries = dict()
+                for entry, notes, idx_text, idx in self.prefixEntry.search(cb):
+                    if (not selected or idx_text in selected) and entry not in entries:
+                        entries[entry] = notes
+                result = entries.items()
+            elif self.normalized:
                 sql = '\n'.join((
-                    "SELECT a.entry, a.notes ",
-                    "  FROM indices as a ",
-                    " INNER JOIN pub AS b ON a.pubkey = b.pubkey ",
-                    " WHERE a.page IS NOT NULL ",
-                    "   AND b.title || ' (' || a.version || ')' IN ({!s}) ",
-                    "   AND a.idx_text IN ({!s}) ",
-                    " GROUP BY a.entry ",
-                    "HAVING entry LIKE '%{!s}%' ",
-                    "ORDER BY idx;"))\
-                    .format(','.join('?' * len(self.valuePub)), ','.join('?' * len(self.valueIndex)), cb)
-                result = conn.execute(sql, self.valuePub, self.valueIndex)
+                    "SELECT l.text, n.notes ",
+                    "  FROM pub_summary AS s ",
+                    " INNER JOIN node AS n ON n.pubkey = s.pubkey AND n.version = s.version ",
+                    " INNER JOIN heading AS h ON h.id = n.heading_id ",
+                    " INNER JOIN label AS l ON l.id = h.label_id ",
+                    " WHERE n.page IS NOT NULL ",
+                    "   AND s.label IN ({!s}) ",
+                    "   AND (n.heading_id IN ({!s}) OR ?) ",
+                    "   AND lower(l.text) LIKE ? ",
+                    " GROUP BY l.text ",
+                    " ORDER BY n.idx;"))\
+                    .format(','.join('?' * len(self.valuePub)), ','.join('?' * len(self.valueHeading)))
+                result = run('entry_filter', sql,
+                             self.valuePub + self.valueHeading + [not self.valueIndex, cb.lower() + '%'])
             else:
                 sql = '\n'.join((
                     "SELECT a.entry, a.notes ",
@@ -609,16 +1511,15 @@ class ExportForm:
                     " INNER JOIN pub AS b ON a.pubkey = b.pubkey ",
                     " WHERE a.page IS NOT NULL ",
                     "   AND b.title || ' (' || a.version || ')' IN ({!s}) ",
-                    "   AND a.idx_text IN ({!s}) ",
+                    "   AND (a.idx_text IN ({!s}) OR ?) ",
+                    "   AND lower(a.entry) LIKE ? ",
                     " GROUP BY a.entry ",
                     "ORDER BY idx;"))\
                     .format(','.join('?' * len(self.valuePub)), ','.join('?' * len(self.valueIndex)))
-                result = conn.execute(sql, self.valuePub, self.valueIndex)
-            for row in result:
-                if not row[1]:
-                    self.lstEntry.insert(END, row[0])
-                else:
-                    self.lstEntry.insert(END, ''.join((row[0], ' | (', row[1], ')')))
+                result = run('entry_filter', sql,
+                             self.valuePub + self.valueIndex + [not self.valueIndex, cb.lower() + '%'])
+            fill(self.lstEntry, 'entry_filter', (row[0] if not row[1] else ''.join((row[0], ' | (', row[1], ')'))
+                                                 for row in result))
 
         # event functions for textbox entry mouse clicks
         def onclick_txtPub(evt):
@@ -645,6 +1546,7 @@ class ExportForm:
         self.lstPub.bind('<<ListboxSelect>>', onselect_Pub)
         self.lstIndex.bind('<<ListboxSelect>>', onselect_Index)
         self.lstEntry.bind('<<ListboxSelect>>', onselect_Entry)
+        self.lstEntry.bind('<Double-Button-1>', onfollow_Entry)
         self.lstPages.bind('<<ListboxSelect>>', onselect_Pages)
         self.sv_pub.trace("w", lambda name, index, mode, sv=self.sv_pub: callback_pub(sv))
         self.sv_idx.trace("w", lambda name, index, mode, sv=self.sv_idx: callback_idx(sv))
@@ -2,12 +2,16 @@
 import argparse
 import os
 import json
+import time
+import hashlib
+import sqlite3 as sqlite
 import bibtexparser
 from bibtexparser.bwriter import BibTexWriter
 from bibtexparser.bibdatabase import BibDatabase
 
 # local
-from classes import Index
+from classes import Index, Bibliography
+from export_index import PUB_FIELDS
 
 
 def write_bib(bib, out_file):
@@ -30,14 +34,23 @@ def write_bib(bib, out_file):
         bibfile.write(writer.write(db))
 
 
-def read_bib(bib_path, arg_bib, bib_id):
-    with open(bib_path) as bibtex_file:
-        bib_database = bibtexparser.load(bibtex_file)
-    entry = [x for x in bib_database.entries if x['ID'] == bib_id]
-    if not entry:
+def read_bib(bib_path, arg_bib, bib_id, store=None):
+    if store is not None:
+        # only reparses the .bib file if it has changed since it was last loaded into the store
+        store.load_bib(bib_path)
+        new_bib = store.get(bib_id)
+    else:
+        with open(bib_path) as bibtex_file:
+            bib_database = bibtexparser.load(bibtex_file)
+        entry = [x for x in bib_database.entries if x['ID'] == bib_id]
+        new_bib = entry[0] if entry else None
+    if not new_bib:
         print("Could not find '", bib_id, "' entry in ", bib_path, ". Quitting...", sep='')
         quit()
-    new_bib = bib_database.entries[0]
+    return merge_bib(new_bib=new_bib, arg_bib=arg_bib)
+
+
+def merge_bib(new_bib, arg_bib):
     combine_bib = dict()
     for key, value in new_bib.items():
         if arg_bib.get(key):
@@ -62,6 +75,139 @@ def read_bib(bib_path, arg_bib, bib_id):
     return combine_bib
 
 
+def read_manifest(manifest_path):
+    """This function reads the JSON list of index sources to watch. Each source is a dictionary with the path of its
+    index file (relative to the manifest), its pubkey and version and optionally link, abbr, adjust, format, sep,
+    pipe_delim, bib_id, entry_type and the bibliography fields of the pub table. Entries without a path, pubkey or
+    version are skipped with a message."""
+    with open(manifest_path, encoding='utf-8') as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise ValueError('the manifest is not a list of sources')
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    sources = []
+    for i, source in enumerate(entries):
+        if not isinstance(source, dict):
+            print('Skipping entry ', i, ' of ', manifest_path, ': not an object', sep='')
+            continue
+        missing = [k for k in ('path', 'pubkey', 'version') if source.get(k) in (None, '')]
+        if missing:
+            print('Skipping entry ', i, ' of ', manifest_path, ': no ', ', '.join(missing), sep='')
+            continue
+        if not isinstance(source['path'], str):
+            print('Skipping entry ', i, ' of ', manifest_path, ': path is not a string', sep='')
+            continue
+        source['path'] = os.path.join(base, source['path'])
+        sources.append(source)
+    return sources
+
+
+class SourceWatcher:
+    """
+    This class keeps a database in step with the index source files listed in a manifest. The files are polled by
+    modification time and size. Once a changed file has been left alone for settle seconds, so that a burst of saves
+    is imported once, its content hash (and that of its manifest entry) is compared with the one recorded when it was
+    last imported. Only if they differ is the file reparsed and its pubkey/version synced with Index.sync_db(), which
+    writes just the rows that changed. The hashes are kept in an index_source table so that unchanged files are not
+    reimported after a restart.
+    """
+
+    source_sql = "CREATE TABLE IF NOT EXISTS index_source (path TEXT PRIMARY KEY, pubkey TEXT, version TEXT, " \
+                 "sha1 TEXT, synced REAL);"
+
+    def __init__(self, manifest, dbpath, settle=1.0, delimiter='|', timeout=60, normalized=False, wal=False):
+        self.manifest = manifest  # the path to the JSON manifest of index sources
+        self.dbpath = dbpath  # the path to the sqlite database
+        self.settle = settle  # seconds a changed file must be left alone before it is imported
+        self.delimiter = delimiter  # the idx_text delimiter passed to Index
+        self.timeout = timeout  # seconds to wait for another connection's write lock before failing
+        self.normalized = normalized  # create a new database with the normalized schema
+        self.wal = wal  # switch the database to write-ahead logging
+        self.sources = []  # the entries of the manifest
+        self.manifest_stat = None  # the (mtime, size) of the manifest when it was last read
+        self.stats = dict()  # path: the (mtime, size) of each source file when it was last polled
+        self.pending = dict()  # path: the time at which a change to the source file was last seen
+        con = sqlite.connect(dbpath, timeout=timeout)
+        con.execute(self.source_sql)
+        con.commit()
+        self.hashes = dict(con.execute("SELECT path, sha1 FROM index_source;").fetchall())
+        con.close()
+
+    @staticmethod
+    def stat(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    @staticmethod
+    def source_hash(source):
+        sha1 = hashlib.sha1(json.dumps(source, sort_keys=True).encode('utf-8'))
+        with open(source['path'], 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+    def poll(self):
+        """This function checks the manifest and the source files once, imports those that have changed and settled,
+        and returns a list of (source, rows) tuples where rows are the metrics returned by Index.sync_db()."""
+        now = time.monotonic()
+        manifest_stat = self.stat(self.manifest)
+        if manifest_stat != self.manifest_stat:
+            try:
+                self.sources = read_manifest(self.manifest)
+                self.manifest_stat = manifest_stat
+                # an edited entry (e.g. a new link) is picked up by its hash even if its file has not changed
+                self.stats.clear()
+            except (OSError, ValueError) as e:
+                # e.g. the manifest is half saved, so it is read again on the next poll
+                print('Could not read ', self.manifest, ': ', e, sep='')
+        for source in self.sources:
+            stat = self.stat(source['path'])
+            if stat != self.stats.get(source['path']):
+                self.stats[source['path']] = stat
+                self.pending[source['path']] = now
+        synced = []
+        for source in self.sources:
+            path = source['path']
+            if path not in self.pending or now - self.pending[path] < self.settle:
+                continue
+            del self.pending[path]
+            if self.stats[path] is None:
+                continue
+            digest = self.source_hash(source)
+            if digest == self.hashes.get(path):
+                continue
+            try:
+                rows = self.sync(source)
+            except Exception as e:
+                # the file is left unrecorded so that it is imported again once it is fixed
+                print('Could not import ', path, ': ', e, sep='')
+                continue
+            con = sqlite.connect(self.dbpath, timeout=self.timeout)
+            con.execute("INSERT OR REPLACE INTO index_source (path, pubkey, version, sha1, synced) "
+                        "VALUES (?, ?, ?, ?, ?);", (path, source['pubkey'], source['version'], digest, time.time()))
+            con.commit()
+            con.close()
+            self.hashes[path] = digest
+            synced.append((source, rows))
+        return synced
+
+    def sync(self, source):
+        bib = {k: source.get(k) for k in PUB_FIELDS}
+        bib['ENTRYTYPE'] = source.get('entry_type', 'misc')
+        bib['ID'] = source.get('bib_id', source['pubkey'])
+        index = Index(path=source['path'], dbpath=self.dbpath, delimiter=self.delimiter, pubkey=source['pubkey'],
+                      abbr=source.get('abbr'), link=source.get('link'), adjust=source.get('adjust', 0),
+                      version=source['version'], bib=merge_bib(new_bib=bib, arg_bib=dict()),
+                      fmt=source.get('format', 'indent'), sep=source.get('sep', '\t'),
+                      pipe_delim=source.get('pipe_delim', '|'), timeout=self.timeout, normalized=self.normalized,
+                      wal=self.wal)
+        index.read_index()
+        return index.sync_db()
+
+
 if __name__ == "__main__":
     # parses script arguments
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -88,6 +234,34 @@ if __name__ == "__main__":
     parser.add_argument('-p', '--page_adjust', type=int, default=0,
                         help='If the page of the PDF is not the same as the page of the text, the adjustment number '
                              'to correct for that (e.g. 1, -2). Negative numbers need to be quoted.')
+    parser.add_argument('-n', '--normalized', action='store_true',
+                        help="When creating a new database, store each distinct heading once in 'label' and 'heading' "
+                             "tables instead of repeating the full idx_text path on every row. 'indices' is then a "
+                             "view with the usual columns.")
+    parser.add_argument('-t', '--timeout', type=float, default=60,
+                        help='The number of seconds to wait for other processes writing to the same database before '
+                             'failing with "database is locked".')
+    parser.add_argument('--wal', action='store_true',
+                        help='Switch the database to write-ahead logging, so that the search window is not blocked '
+                             'while an import is written. This is a lasting setting of the database file and is not '
+                             'supported on network filesystems.')
+    parser.add_argument('-f', '--format', default='indent', choices=['indent', 'pipe'],
+                        help="The format of the input file. 'indent' is a tab indented index. 'pipe' is a delimited "
+                             "file of category paths (e.g. category|sub|entry) and pages with no header.")
+    parser.add_argument('--sep', default='\t',
+                        help="The field delimiter between the category path and pages of a 'pipe' format input.")
+    parser.add_argument('-P', '--pipe_delim', default='|',
+                        help="The delimiter between categories of a 'pipe' format input.")
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help="Treat path as a JSON manifest of index sources and keep the out_file database in step "
+                             "with them, reimporting each source file when it changes. See README.")
+    parser.add_argument('--interval', type=float, default=2,
+                        help='When watching, the number of seconds between checks of the source files.')
+    parser.add_argument('--settle', type=float, default=1,
+                        help='When watching, the number of seconds a changed file must be left alone before it is '
+                             'imported, so that a burst of saves is imported once.')
+    parser.add_argument('--once', action='store_true',
+                        help='When watching, import the changed sources once and exit.')
     parser.add_argument('-c', '--conflict', default='fail', choices=['fail', 'ignore', 'replace'],
                         help='If there is a record conflict on a database insert, then fail/ignore/replace on '
                              'the record insert.')
@@ -102,6 +276,13 @@ if __name__ == "__main__":
                         choices=['article', 'book', 'booklet', 'inbook', 'incollection', 'inproceedings', 'manual',
                                  'mastersthesis', 'misc', 'phdthesis', 'proceedings', 'techreport', 'unpublished'])
     parser.add_argument('--bib_id', help="The BibTeX id of the entry for reading/writing to .bib files.")
+    parser.add_argument('-s', '--bib_store',
+                        help="Path to a sqlite database in which to keep a 'bib' table of BibTeX entries keyed by ID, "
+                             "so that .bib files are not reparsed and rewritten on every run. This may be the same "
+                             "database as out_file.")
+    parser.add_argument('-E', '--export_bib', action='store_true',
+                        help="When using a bib store, write all stored entries to the 'write_bib' path in one pass. "
+                             "Without this flag 'write_bib' only updates the store.")
     parser.add_argument('--author', help="The author(s) of the text")
     parser.add_argument('--title', help="The full title of the text the index references (e.g. Player's Handbook)")
     parser.add_argument('--edition', help="The numerical edition of the text (e.g. 1, 3.5)")
@@ -116,6 +297,29 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
+    if args.watch:
+        if os.path.splitext(args.out_file)[1] not in ['.db', '.sqlite']:
+            print("Watching requires a 'db' or 'sqlite' out_file. Quitting...")
+            quit()
+        watcher = SourceWatcher(manifest=args.path, dbpath=args.out_file, settle=0 if args.once else args.settle,
+                                delimiter=args.index_delimiter, timeout=args.timeout, normalized=args.normalized,
+                                wal=args.wal)
+        try:
+            while True:
+                for source, rows in watcher.poll():
+                    print('{!s} ({!s}): {!s} rows written, {!s} rows deleted in {:.2f}s'.format(
+                        source['pubkey'], source['version'], rows['index_rows'], rows['deleted_rows'],
+                        rows['write_time']))
+                    for idx, target in rows['unresolved']:
+                        print("Could not resolve cross reference '", target, "' of entry ", idx, '.', sep='')
+                if args.once:
+                    break
+                time.sleep(args.interval)
+        except KeyboardInterrupt:
+            pass
+        print('Script finished.')
+        quit()
+
     if args.write_bib or args.read_bib:
         if not (args.pubkey or args.bib_id):
             print("Reading or writing to .bib file requires either pubkey or bib_id.  Quitting...")
@@ -142,13 +346,19 @@ if __name__ == "__main__":
         'ID': id
     }
 
+    if args.bib_store:
+        bib_store = Bibliography(dbpath=args.bib_store, timeout=args.timeout)
+    else:
+        bib_store = None
+
     if args.read_bib:
-        bib_dict = read_bib(bib_path=args.read_bib, arg_bib=bib_dict, bib_id=id)
+        bib_dict = read_bib(bib_path=args.read_bib, arg_bib=bib_dict, bib_id=id, store=bib_store)
 
     my_index = Index(path=args.path, dbpath=args.out_file, delimiter=args.index_delimiter, pubkey=args.pubkey,
                      abbr=args.abbr, link=args.link, adjust=args.page_adjust, conflict=args.conflict,
-                     version=args.version, bib=bib_dict)
-    my_index.text_to_dict()
+                     version=args.version, bib=bib_dict, fmt=args.format, sep=args.sep, pipe_delim=args.pipe_delim,
+                     timeout=args.timeout, normalized=args.normalized, wal=args.wal)
+    my_index.read_index()
     if os.path.splitext(args.out_file)[1] == '.json':
         my_index.dict_to_tree()
         with open(args.out_file, 'w', encoding='utf-8') as file:
@@ -157,11 +367,24 @@ if __name__ == "__main__":
         rows = my_index.dict_to_db()
         print(rows['pub_rows'], 'rows inserted into table pub')
         print(rows['index_rows'], 'rows inserted into table indices')
+        print('waited {:.2f}s for the write lock, wrote in {:.2f}s'.format(rows['lock_wait'], rows['write_time']))
+        for idx, target in rows['unresolved']:
+            print("Could not resolve cross reference '", target, "' of entry ", idx, '.', sep='')
     else:
         my_index.dict_to_df()
         my_index.df_index.to_csv(args.out_file, sep=args.delim, index=False)
 
     if args.write_bib:
         strip_dict = {k: str(v) for k, v in bib_dict.items() if v}
-        write_bib(bib=strip_dict, out_file=args.write_bib)
+        if bib_store is None:
+            write_bib(bib=strip_dict, out_file=args.write_bib)
+        else:
+            bib_store.upsert(strip_dict, bib_path=args.write_bib)
+            if args.export_bib:
+                # pull in any entries already in the .bib file that the store has not seen yet
+                if os.path.isfile(args.write_bib):
+                    bib_store.load_bib(args.write_bib)
+                    bib_store.upsert(strip_dict, bib_path=args.write_bib)
+                n = bib_store.export_bib(args.write_bib)
+                print(n, 'entries written to', args.write_bib)
     print('Script finished.')
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import json
+import re
+
+# local
+from export_index import connect, idx_key, iter_rows
+
+
+def norm_path(idx_text, delimiter='|'):
+    """This function normalizes an idx_text path for matching: each level is case-folded and its white space is
+    collapsed, so 'Combat| Actions' and 'combat|actions' are the same path."""
+    return tuple(' '.join(x.split()).casefold() for x in idx_text.split(delimiter))
+
+
+def norm_pages(page):
+    """This function turns a page string such as '12, 14-16' into a set of page tokens, so that the order and spacing
+    of the pages does not matter."""
+    if not page:
+        return frozenset()
+    return frozenset(x for x in re.split(r'\s*,\s*', page.strip()) if x)
+
+
+def load_version(con, pubkey, version, delimiter='|'):
+    """This function hashes every entry of a pubkey/version by its normalized path. Paths that occur more than once
+    keep a list of their rows."""
+    paths = dict()
+    for row in iter_rows(con, pubkey, version, ordered=False):
+        item = {'idx': row['idx'], 'idx_text': row['idx_text'], 'entry': row['entry'], 'page': row['page'],
+                'pages': norm_pages(row['page'])}
+        paths.setdefault(norm_path(row['idx_text'], delimiter), []).append(item)
+    return paths
+
+
+def diff_versions(con, pubkey, version_a, version_b, delimiter='|'):
+    """This function compares two versions of the index of a publication. Entries are matched by a hash join on their
+    normalized paths rather than by idx, so renumbered headings do not show up as changes. Returns a dictionary of
+    lists of changes:
+    'added' and 'removed': entries only in version_b or version_a;
+    'moved': entries whose path changed but whose entry text and pages did not;
+    'pages': entries with the same path but a different set of pages."""
+    a = load_version(con, pubkey, version_a, delimiter)
+    b = load_version(con, pubkey, version_b, delimiter)
+    changes = {'added': [], 'removed': [], 'moved': [], 'pages': []}
+    removed = []
+    for path, items_a in a.items():
+        # rows of a repeated path are paired with a row of the same pages first, and only the rows left over are
+        # paired as page changes, so that adding or removing one of them is not reported as changes to the others
+        same = dict()
+        for item in b.pop(path, []):
+            same.setdefault(item['pages'], []).append(item)
+        unpaired = []
+        for item in items_a:
+            if same.get(item['pages']):
+                same[item['pages']].pop(0)
+            else:
+                unpaired.append(item)
+        # the rows left over on either side are paired in index order
+        unpaired.sort(key=lambda x: idx_key(x['idx']))
+        items_b = sorted((item for items in same.values() for item in items), key=lambda x: idx_key(x['idx']))
+        for i, item in enumerate(unpaired):
+            if i >= len(items_b):
+                removed.append((path, item))
+            else:
+                changes['pages'].append({'idx_text': item['idx_text'], 'old_page': item['page'],
+                                         'new_page': items_b[i]['page'], 'old_idx': item['idx'],
+                                         'new_idx': items_b[i]['idx']})
+        if len(items_b) > len(unpaired):
+            b[path] = items_b[len(unpaired):]
+
+    # whatever is left unmatched by path may have been moved: hash join on the entry text and its pages
+    added = dict()
+    for path, items in b.items():
+        for item in items:
+            added.setdefault((path[-1], item['pages']), []).append(item)
+    for path, item in removed:
+        moved_to = added.get((path[-1], item['pages']))
+        if moved_to:
+            new = moved_to.pop(0)
+            changes['moved'].append({'idx_text': new['idx_text'], 'old_idx_text': item['idx_text'],
+                                     'old_page': item['page'], 'new_page': new['page'], 'old_idx': item['idx'],
+                                     'new_idx': new['idx']})
+        else:
+            changes['removed'].append({'idx_text': item['idx_text'], 'old_page': item['page'], 'old_idx': item['idx']})
+    for items in added.values():
+        for item in items:
+            changes['added'].append({'idx_text': item['idx_text'], 'new_page': item['page'], 'new_idx': item['idx']})
+    return changes
+
+
+if __name__ == "__main__":
+    # parses script arguments
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Compares two versions of the index of a publication in a database '
+                                                 'created with convert_index.py and reports the added, removed, moved '
+                                                 'and page-changed entries.')
+    # positional arguments
+    parser.add_argument('dbpath', help='The file path to the database file.')
+    parser.add_argument('pubkey', help='The pubkey of the publication to compare.')
+    parser.add_argument('version_a', help="The old version (e.g. 'original').")
+    parser.add_argument('version_b', help="The new version (e.g. 'improved').")
+    # options
+    parser.add_argument('-o', '--out_file',
+                        help="A file to write the changes to. A 'json' extension will produce a JSON file, anything "
+                             "else a delimited file with a 'change' column. Changes are printed if not given.")
+    parser.add_argument('-i', '--index_delimiter', default='|',
+                        help="The delimiter used to separate categories in the idx_text column.")
+    args = parser.parse_args()
+
+    conn = connect(args.dbpath)
+    result = diff_versions(conn, args.pubkey, args.version_a, args.version_b, delimiter=args.index_delimiter)
+    conn.close()
+    fields = ['change', 'idx_text', 'old_idx_text', 'old_page', 'new_page', 'old_idx', 'new_idx']
+    if args.out_file and args.out_file.endswith('.json'):
+        with open(args.out_file, 'w', encoding='utf-8') as file:
+            json.dump(result, file, ensure_ascii=False, indent=4)
+    elif args.out_file:
+        with open(args.out_file, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=fields)
+            writer.writeheader()
+            for change, items in result.items():
+                for item in items:
+                    writer.writerow(dict(item, change=change))
+    else:
+        symbols = {'added': '+', 'removed': '-', 'moved': '>', 'pages': '~'}
+        for change, items in result.items():
+            for item in items:
+                if change == 'moved':
+                    text = ' -> '.join((item['old_idx_text'], item['idx_text']))
+                elif change == 'pages':
+                    text = ''.join((item['idx_text'], ': ', str(item['old_page']), ' -> ', str(item['new_page'])))
+                else:
+                    text = ''.join((item['idx_text'], ': ', str(item.get('new_page', item.get('old_page')))))
+                print(symbols[change], text)
+    print(', '.join('{!s} {!s}'.format(len(v), k) for k, v in result.items()))
+    print('Script finished.')
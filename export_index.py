@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import csv
+import json
+import sqlite3 as sqlite
+
+BATCH_SIZE = 1000  # the number of rows to pull from a cursor at a time
+PUB_FIELDS = ['author', 'title', 'edition', 'publisher', 'month', 'year', 'volume', 'series', 'address', 'note', 'isbn']
+
+
+def idx_key(idx):
+    """This function turns a numeric style text index (e.g. '1.10.2') into a string that sorts in natural order
+    (e.g. '000001.000010.000002'), so that '1.2' sorts before '1.10'."""
+    return '.'.join(x.zfill(6) for x in idx.split('.'))
+
+
+def connect(dbpath):
+    con = sqlite.connect(dbpath)
+    con.create_function('idx_key', 1, idx_key, deterministic=True)
+    return con
+
+
+def get_versions(con, pubkeys=None, versions=None):
+    """This function returns the (pubkey, version) pairs in the database, optionally limited to the given lists."""
+    sql = "SELECT DISTINCT pubkey, version FROM indices"
+    where = []
+    params = []
+    if pubkeys:
+        where.append("pubkey IN ({!s})".format(','.join('?' * len(pubkeys))))
+        params += pubkeys
+    if versions:
+        where.append("version IN ({!s})".format(','.join('?' * len(versions))))
+        params += versions
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY pubkey, version;"
+    return con.execute(sql, params).fetchall()
+
+
+def iter_rows(con, pubkey, version, ordered=True):
+    """This function yields the indices rows of a pubkey/version as dictionaries in natural idx order (or in primary
+    key order if not ordered), fetching them from the cursor in batches so that memory use does not grow with the size
+    of the index."""
+    order = 'idx_key(idx)' if ordered else 'idx'
+    cur = con.execute("SELECT pubkey, version, entry, idx, idx_text, page, notes FROM indices "
+                      "WHERE pubkey = ? AND version = ? ORDER BY {!s};".format(order), (pubkey, version))
+    names = [x[0] for x in cur.description]
+    while True:
+        rows = cur.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            yield dict(zip(names, row))
+
+
+def get_bib(con, pubkey):
+    """This function returns the bibliography info stored in the pub table for pubkey in the dictionary form used by
+    the Index class."""
+    rec = con.execute("SELECT {!s} FROM pub WHERE pubkey = ?;".format(', '.join(PUB_FIELDS)), (pubkey,)).fetchone()
+    if rec is None:
+        return None
+    bib = dict(zip(PUB_FIELDS, rec))
+    bib['ID'] = pubkey
+    return bib
+
+
+def row_to_line(row):
+    """This function rebuilds a line of the tab indented source format that Index.text_to_dict() parses back into the
+    same entry, note and page values."""
+    depth = len(row['idx'].split('.')) - 1
+    parts = [row['entry']] + [x for x in [row['notes'], row['page']] if x]
+    return '\t' * depth + ', '.join(parts) + '\n'
+
+
+def write_text(con, pubkey, version, out):
+    count = 0
+    for row in iter_rows(con, pubkey, version):
+        out.write(row_to_line(row))
+        count += 1
+    return count
+
+
+def write_csv(con, pairs, out, delim=','):
+    writer = csv.writer(out, delimiter=delim, lineterminator='\n')
+    writer.writerow(['pubkey', 'version', 'entry', 'idx', 'idx_text', 'page', 'notes'])
+    count = 0
+    for pubkey, version in pairs:
+        for row in iter_rows(con, pubkey, version):
+            writer.writerow([row['pubkey'], row['version'], row['entry'], row['idx'], row['idx_text'], row['page'],
+                             row['notes']])
+            count += 1
+    return count
+
+
+def write_json(con, pubkey, version, out, indent=4):
+    """This function writes the same tree as Index.dict_to_tree() but node by node, closing each node once a row at
+    the same or a shallower depth is reached, so the whole tree is never held in memory."""
+    def pad(level):
+        return '\n' + ' ' * (indent * level)
+
+    def dump(value):
+        return json.dumps(value, ensure_ascii=False)
+
+    out.write('{' + pad(1) + '"bib": ')
+    out.write(json.dumps(get_bib(con, pubkey), ensure_ascii=False, indent=indent).replace('\n', pad(1)))
+    out.write(',' + pad(1) + '"entries": [')
+    stack = []  # one item per open node: whether its children list has been started
+    count = 0
+
+    def close_node():
+        has_children = stack.pop()
+        level = 2 * len(stack) + 2
+        if has_children:
+            out.write(pad(level + 1) + ']')
+        out.write(pad(level) + '}')
+
+    for row in iter_rows(con, pubkey, version):
+        depth = len(row['idx'].split('.')) - 1
+        while len(stack) > depth:
+            close_node()
+        if stack and not stack[-1]:
+            out.write(',' + pad(2 * len(stack) + 1) + '"children": [')
+            stack[-1] = True
+            sep = ''
+        elif stack or count:
+            sep = ','
+        else:
+            sep = ''
+        level = 2 * len(stack) + 2
+        fields = [('text', row['entry'])]
+        if row['notes']:
+            fields.append(('note', row['notes']))
+        if row['page']:
+            plist = [x.strip() for x in row['page'].split(',')]
+            fields.append(('p', plist if len(plist) > 1 else plist[0]))
+        fields.append(('idx', row['idx']))
+        out.write(sep + pad(level) + '{' + ','.join(pad(level + 1) + dump(k) + ': ' + dump(v) for k, v in fields))
+        stack.append(False)
+        count += 1
+    while stack:
+        close_node()
+    out.write(pad(1) + ']\n}\n')
+    return count
+
+
+def export(dbpath, out_file, pubkeys=None, versions=None, fmt=None, delim=','):
+    """This function exports the selected pubkey/versions from the database to out_file. Text and JSON outputs hold a
+    single index, so when more than one pubkey/version is selected out_file is treated as a directory and one file is
+    written per pubkey/version."""
+    if fmt is None:
+        ext = os.path.splitext(out_file)[1]
+        fmt = {'.json': 'json', '.csv': 'csv'}.get(ext, 'text')
+    con = connect(dbpath)
+    pairs = get_versions(con, pubkeys=pubkeys, versions=versions)
+    assert pairs, 'no indices found for the given pubkey/version'
+    counts = dict()
+    if fmt == 'csv':
+        with open(out_file, 'w', newline='', encoding='utf-8') as f:
+            counts[out_file] = write_csv(con, pairs, f, delim=delim)
+    else:
+        ext = '.json' if fmt == 'json' else '.txt'
+        write_func = write_json if fmt == 'json' else write_text
+        if len(pairs) > 1 or os.path.isdir(out_file):
+            os.makedirs(out_file, exist_ok=True)
+            paths = [os.path.join(out_file, '_'.join((p, v)) + ext) for p, v in pairs]
+        else:
+            paths = [out_file]
+        for (pubkey, version), path in zip(pairs, paths):
+            with open(path, 'w', encoding='utf-8') as f:
+                counts[path] = write_func(con, pubkey, version, f)
+    con.close()
+    return counts
+
+
+if __name__ == "__main__":
+    # parses script arguments
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Exports indices stored in a database created with convert_index.py '
+                                                 'back to the tab indented text format, a delimited file or JSON.')
+    # positional arguments
+    parser.add_argument('dbpath', help='The file path to the database file.')
+    parser.add_argument('out_file',
+                        help="The path to the output file. If more than one pubkey/version is exported to text or "
+                             "JSON, this is a directory in which a 'pubkey_version' file is written for each.")
+    # options
+    parser.add_argument('-k', '--pubkey', nargs='+', help='The pubkey(s) to export. All are exported if not given.')
+    parser.add_argument('-v', '--version', nargs='+', help='The version(s) to export. All are exported if not given.')
+    parser.add_argument('-f', '--format', choices=['text', 'csv', 'json'],
+                        help="The output format. By default a 'json' extension produces JSON, a 'csv' extension a "
+                             "delimited file and anything else the tab indented text format.")
+    parser.add_argument('-d', '--delim', default=',', help='The field delimiter to use for a delimited output.')
+    args = parser.parse_args()
+
+    result = export(dbpath=args.dbpath, out_file=args.out_file, pubkeys=args.pubkey, versions=args.version,
+                    fmt=args.format, delim=args.delim)
+    for path, rows in result.items():
+        print(rows, 'rows written to', path)
+    print('Script finished.')
@@ -3,9 +3,86 @@ import tkinter
 import os
 import sqlite3 as sqlite
 import argparse
+import tempfile
+import threading
 
 # local
-from classes import ExportForm
+from classes import ExportForm, QueryTracer
+
+
+def copy_db(source, dest, label='Loading database', pages=256):
+    """This function copies the database at connection source into connection dest with the sqlite backup API, a few
+    pages at a time, printing its progress."""
+    last = [None]
+
+    def progress(status, remaining, total):
+        percent = int(100 * (total - remaining) / total) if total else 100
+        if percent != last[0]:
+            print('\r{!s}: {!s}%'.format(label, percent), end='', flush=True)
+            last[0] = percent
+    source.backup(dest, pages=pages, progress=progress)
+    print('\r{!s}: done'.format(label))
+
+
+def db_version(source, dbpath):
+    """This function returns a value that changes whenever the database at dbpath is changed, either by another
+    connection (data_version) or by the file being replaced (the modification times of the database and its WAL)."""
+    mtimes = tuple(os.path.getmtime(x) if os.path.exists(x) else None for x in (dbpath, dbpath + '-wal'))
+    return source.execute("PRAGMA data_version;").fetchone()[0], mtimes
+
+
+class Refresher:
+    """
+    This class polls the source database from the Tk main loop and, when it has changed, copies it into a fresh
+    connection on a background thread so that the slow read does not block the window. The finished copy is then
+    swapped into the connection used by ExportForm in one fast step on the main thread. The version of the source is
+    only recorded once its copy has been swapped in, so a copy that fails is tried again on the next check.
+    """
+
+    def __init__(self, root, form, conn, dbpath, interval):
+        self.root = root
+        self.form = form  # the ExportForm to refresh
+        self.conn = conn  # the local connection the ExportForm queries
+        self.dbpath = dbpath  # the path to the (remote) source database
+        self.interval = int(interval * 1000)  # milliseconds between checks
+        self.source = sqlite.connect(dbpath)
+        self.version = db_version(self.source, dbpath)
+        self.copy = None  # the connection holding a finished copy and the source version it was copied from
+        self.thread = None
+        self.root.after(self.interval, self.check)
+
+    def check(self):
+        if self.thread is None:
+            version = db_version(self.source, self.dbpath)
+            if version != self.version:
+                self.thread = threading.Thread(target=self.load, args=(version,), daemon=True)
+                self.thread.start()
+        elif not self.thread.is_alive():
+            self.thread = None
+            if self.copy is not None:
+                copy, self.version = self.copy
+                self.copy = None
+                copy.backup(self.conn)
+                copy.close()
+                # reloads the publication list from the refreshed copy
+                self.form.sv_pub.set(self.form.sv_pub.get())
+        self.root.after(self.interval, self.check)
+
+    def load(self, version):
+        copy = sqlite.connect(':memory:', check_same_thread=False)
+        try:
+            source = sqlite.connect(self.dbpath)
+            try:
+                copy_db(source, copy, label='Refreshing database')
+            finally:
+                source.close()
+        except Exception as e:
+            # e.g. the network share is briefly unavailable
+            print('\nCould not refresh ', self.dbpath, ': ', e, sep='')
+            copy.close()
+            return
+        self.copy = (copy, version)
+
 
 if __name__ == "__main__":
     # parses script arguments
@@ -13,6 +90,21 @@ if __name__ == "__main__":
                                      description='Creates a Tkinter window to search indices in a database format.')
     parser.add_argument('-d', '--dbpath', help='The file path to the database file created with convert_index.py '
                         'or via the "Index" class in classes.py')
+    parser.add_argument('-c', '--cache', choices=['memory', 'temp'],
+                        help="Copy the database into memory ('memory') or a local temporary file ('temp') at startup "
+                             "and search the copy, e.g. when the database is on a slow network share.")
+    parser.add_argument('-w', '--watch', type=float,
+                        help='When using a cache, check the database for changes every this many seconds and reload '
+                             'the copy in the background.')
+    parser.add_argument('-i', '--index_delimiter', default='|',
+                        help="The delimiter used to separate categories in the idx_text column, as given to "
+                             "convert_index.py.")
+    parser.add_argument('-t', '--trace',
+                        help='Time every query the window issues and the list box inserts of its rows, and write '
+                             'the timings per kind of query and a log of the slow queries with their query plans to '
+                             'this JSON file on exit.')
+    parser.add_argument('--slow_ms', type=float, default=100,
+                        help='When tracing, the number of milliseconds above which a query is logged as slow.')
     args = parser.parse_args()
 
     try:
@@ -25,12 +117,34 @@ if __name__ == "__main__":
         dbpath = os.path.join(scrptdir, "indices.sqlite")
         print("DB not provided. Using default path:", dbpath)
     assert os.path.exists(dbpath), ' '.join((dbpath, 'does not exist.'))
-    conn = sqlite.connect(dbpath)
+    temp_dir = None
+    if args.cache:
+        if args.cache == 'memory':
+            conn = sqlite.connect(':memory:')
+        else:
+            temp_dir = tempfile.TemporaryDirectory()
+            conn = sqlite.connect(os.path.join(temp_dir.name, os.path.basename(dbpath)))
+        source = sqlite.connect(dbpath)
+        copy_db(source, conn)
+        source.close()
+    else:
+        conn = sqlite.connect(dbpath)
     root = tkinter.Tk()
     root.title("Index Crawler")
     icon = tkinter.PhotoImage(file='icon.png')
     root.iconphoto(False, icon)
-    mf = ExportForm(root, conn, scrptdir)
+    tracer = QueryTracer(threshold=args.slow_ms / 1000) if args.trace else None
+    mf = ExportForm(root, conn, scrptdir, tracer=tracer, delimiter=args.index_delimiter)
+    if args.cache and args.watch:
+        refresher = Refresher(root, mf, conn, dbpath, args.watch)
     root.mainloop()
     conn.close()
-
+    if tracer is not None:
+        tracer.export(args.trace)
+        for kind, stats in tracer.to_dict()['kinds'].items():
+            print('{!s}: {!s} queries, mean {:.1f}ms, max {:.1f}ms, {!s} rows, {:.1f}ms inserting'.format(
+                kind, stats['count'], 1000 * (stats['mean_time'] or 0), 1000 * stats['max_time'], stats['rows'],
+                1000 * stats['insert_time']))
+        print(len(tracer.slow), 'slow queries written to', args.trace)
+    if temp_dir is not None:
+        temp_dir.cleanup()